@@ -1,24 +1,37 @@
 import asyncio
 import datetime
+import multiprocessing
 import os
 import sys
 
 import api
 import config
 import core
+import image
 import log
+import metrics
 import runtime
 from model import *
 
 
 async def main():
     core.main_event_loop = asyncio.get_event_loop()
+    core.start_delivery_worker()
+    image.start_cache_manager()
     core.update_getters()
+    loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
 
-    await api.serve()
+    try:
+        await api.serve()
+    finally:
+        loop_monitor.cancel()
+        image.stop_cache_manager()
+        image.shutdown_process_pool()
+        await core.shutdown()
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     log.info(f"MessageSyncer ({runtime.version}) started")
     log.info(f"at {Path().absolute()}")
     if runtime.run_in_frozen_mode:
@@ -1,7 +1,9 @@
 import asyncio
+import base64
+import json
 import mimetypes
 import time
-from typing import Annotated, Any, Optional, Union
+from typing import Annotated, Any, Callable, Optional, Union
 
 import uvicorn
 from fastapi import (
@@ -16,12 +18,20 @@ from fastapi import (
     status,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+)
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
 import config
 import core
+import image
 import log
+import metrics
+import profiling
 import runtime
 import store
 import task
@@ -46,6 +56,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -105,6 +116,99 @@ class Article:
     content: list[dict]
 
 
+@dataclass
+class ArticleSearchResult(Article):
+    snippet: str
+
+
+@dataclass
+class OutboxEntry:
+    id: int
+    article: str
+    pusher: str
+    state: str
+    attempts: int
+    next_attempt_ts: float
+    last_error: Optional[str]
+    last_attempt_duration: Optional[float]
+    last_attempt_stages: Optional[dict[str, float]]  # push.wait, push.connect, ...
+    created_ts: float
+
+    @staticmethod
+    def from_model(entry: store.Outbox):
+        return OutboxEntry(
+            id=entry.id,
+            article=entry.article,
+            pusher=entry.pusher,
+            state=entry.state,
+            attempts=entry.attempts,
+            next_attempt_ts=entry.next_attempt_ts,
+            last_error=entry.last_error,
+            last_attempt_duration=entry.last_attempt_duration,
+            last_attempt_stages=(
+                json.loads(entry.last_attempt_stages)
+                if entry.last_attempt_stages is not None
+                else None
+            ),
+            created_ts=entry.created_ts,
+        )
+
+
+@dataclass
+class RefreshHistoryEntry:
+    id: int
+    getter: str
+    start_ts: float
+    duration: float
+    outcome: str
+    error: Optional[str]
+    stages: dict[str, float]
+    counts: dict[str, int]
+
+    @staticmethod
+    def from_model(entry: store.RefreshHistory):
+        return RefreshHistoryEntry(
+            id=entry.id,
+            getter=entry.getter,
+            start_ts=entry.start_ts,
+            duration=entry.duration,
+            outcome=entry.outcome,
+            error=entry.error,
+            stages=json.loads(entry.stages),
+            counts=json.loads(entry.counts),
+        )
+
+
+@dataclass
+class ProfileRequestBody:
+    mode: str = "sample"  # cprofile, sample or tracemalloc
+    seconds: float = 10  # With getter, the most to wait for its refresh
+    getter: Optional[str] = None  # Profile a refresh of this getter only
+
+
+@dataclass
+class ProfileInfo:
+    mode: str
+    seconds: float
+    getter: Optional[str]
+    running: bool
+    start_ts: float
+    end_ts: Optional[float]
+    error: Optional[str]
+
+    @staticmethod
+    def from_session(session: profiling.Session):
+        return ProfileInfo(
+            mode=session.mode,
+            seconds=session.seconds,
+            getter=session.getter,
+            running=session.running,
+            start_ts=session.start_ts,
+            end_ts=session.end_ts,
+            error=session.error,
+        )
+
+
 @dataclass
 class AdapterInstallRequestBody:
     url: str
@@ -115,6 +219,14 @@ async def _():
     return RedirectResponse("./docs")
 
 
+@app.get("/metrics", tags=["Metrics"], response_class=PlainTextResponse)
+async def get_metrics(auth=Depends(authenticate)):
+    """Metrics in the Prometheus text format."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @api_router.get("/")
 async def hello_world() -> dict:
     return {
@@ -155,9 +267,8 @@ async def uninstall_adapter(
 
 
 def _get_adapter_class(adapter_class: str) -> Getter:
-    ls = [_c for _c in core.imported_adapter_classes if _c.__name__ == adapter_class]
-    if len(ls) != 0:
-        return ls[0]
+    if cls := core.find_imported_class(adapter_class):
+        return cls
     raise HTTPException(status.HTTP_404_NOT_FOUND)
 
 
@@ -218,9 +329,8 @@ async def get_config_jsonschema(
 
 
 def _get_getter(getter: str) -> Getter:
-    ls = [_getter for _getter in core.registered_getters if _getter.name == getter]
-    if len(ls) != 0:
-        return ls[0]
+    if _getter := core.registered_getters_by_name.get(getter):
+        return _getter
     raise HTTPException(status.HTTP_404_NOT_FOUND)
 
 
@@ -258,6 +368,32 @@ async def refresh_getter_async(
     )
 
 
+@api_router.get("/getters/{getter:str}/history", tags=["Getter"])
+async def getter_refresh_history(
+    getter: str,
+    before: Optional[int] = None,
+    limit: int = 20,
+    auth=Depends(authenticate),
+) -> list[RefreshHistoryEntry]:
+    """The latest refreshes of getter, latest first, with the seconds spent in each
+    stage. Pass the id of the last one as before for older ones. Getters no longer
+    configured are kept.
+
+    Pushes are only part of a refresh when it delivers its articles itself, i.e. the
+    delivery worker isn't running, which it always is in the app. Otherwise deliver
+    only covers handing them over, and push timings are in the outbox entries of
+    failed attempts and in the push duration metrics."""
+    entries = await _read(store.query_refresh_history, getter, before, limit)
+    return [RefreshHistoryEntry.from_model(entry) for entry in entries]
+
+
+async def _read(function: Callable, *args, **kwargs):
+    """Read from the store off the event loop, which a slow query, or a wait for the
+    lock of a writer, would stall otherwise. Dependencies defined with def, like
+    _get_article, already run in FastAPI's threadpool."""
+    return await asyncio.to_thread(function, *args, **kwargs)
+
+
 def _get_article(id: str) -> store.Article:
     ar = store.Article.get_or_none(store.Article.id == id)
     if ar:
@@ -266,15 +402,71 @@ def _get_article(id: str) -> store.Article:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
 
 
+def _encode_cursor(article: store.Article) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([article.ts, article.id]).encode()
+    ).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[int, str]:
+    try:
+        ts, id_ = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(ts), str(id_)
+    except Exception:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
+
+
 @api_router.get("/articles/", tags=["Article"])
 async def list_articles(
-    page: int = 0, page_size: int = 10, auth=Depends(authenticate)
+    response: Response,
+    userId: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    cursor: Optional[str] = None,
+    page: int = 0,
+    page_size: int = 10,
+    auth=Depends(authenticate),
 ) -> list[Article]:
+    """List articles, newest first, optionally of userId and with since <= ts < until.
+
+    If there may be more articles, the X-Next-Cursor response header holds a cursor
+    to pass as cursor for the next page. Pages by cursor stay fast however deep they
+    go, unlike page, which is kept for compatibility.
+    """
+    before = _decode_cursor(cursor) if cursor is not None else None
+    # Like peewee's paginate, pages start at 1 and page 0 is the first page too
+    offset = 0 if before is not None else max(page - 1, 0) * page_size
+    articles = await _read(
+        store.query_articles,
+        user_id=userId,
+        since=since,
+        until=until,
+        before=before,
+        limit=page_size,
+        offset=offset,
+    )
+    if articles and len(articles) == page_size:
+        response.headers["X-Next-Cursor"] = _encode_cursor(articles[-1])
+    return [Article(ar.id, ar.userId, ar.ts, ar.content.asdict()) for ar in articles]
+
+
+@api_router.get("/articles/search", tags=["Article"])
+async def search_articles(
+    q: str, page: int = 0, page_size: int = 10, auth=Depends(authenticate)
+) -> list[ArticleSearchResult]:
+    """Full-text search of articles by text and userId, best matches first.
+
+    snippet is an excerpt of the article's text with the matches marked **like this**.
+    """
+    results = await _read(
+        store.search_articles,
+        q,
+        limit=page_size,
+        offset=max(page - 1, 0) * page_size,
+    )
     return [
-        Article(ar.id, ar.userId, ar.ts, ar.content.asdict())
-        for ar in store.Article.select()
-        .order_by(store.Article.ts.desc())
-        .paginate(page, page_size)
+        ArticleSearchResult(ar.id, ar.userId, ar.ts, ar.content.asdict(), snippet)
+        for ar, snippet in results
     ]
 
 
@@ -285,14 +477,174 @@ async def article(
     return Article(article.id, article.userId, article.ts, article.content.asdict())
 
 
+def _get_outbox_entry(entry_id: int) -> store.Outbox:
+    entry = store.Outbox.get_or_none(store.Outbox.id == entry_id)
+    if entry:
+        return entry
+    else:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+
+
+@api_router.get("/outbox/", tags=["Outbox"])
+async def list_outbox(
+    state: Optional[str] = None,
+    page: int = 0,
+    page_size: int = 10,
+    auth=Depends(authenticate),
+) -> list[OutboxEntry]:
+    query = store.Outbox.select()
+    if state is not None:
+        query = query.where(store.Outbox.state == state)
+    entries = await _read(
+        list, query.order_by(store.Outbox.id).paginate(page, page_size)
+    )
+    return [OutboxEntry.from_model(entry) for entry in entries]
+
+
+@api_router.post("/outbox/requeue", response_model=type(None), tags=["Outbox"])
+async def requeue_dead_outbox_entries(auth=Depends(authenticate)):
+    def requeue_dead():
+        dead = store.Outbox.select().where(store.Outbox.state == store.Outbox.DEAD)
+        for entry in dead:
+            core.requeue_delivery(entry)
+
+    await asyncio.to_thread(requeue_dead)
+
+
+@api_router.get("/outbox/{entry_id:int}", tags=["Outbox"])
+async def outbox_entry(
+    entry: store.Outbox = Depends(_get_outbox_entry), auth=Depends(authenticate)
+) -> OutboxEntry:
+    return OutboxEntry.from_model(entry)
+
+
+@api_router.post(
+    "/outbox/{entry_id:int}/requeue", response_model=type(None), tags=["Outbox"]
+)
+async def requeue_outbox_entry(
+    entry: store.Outbox = Depends(_get_outbox_entry), auth=Depends(authenticate)
+):
+    await asyncio.to_thread(core.requeue_delivery, entry)
+
+
+def _log_level(level: Optional[str]) -> Optional[int]:
+    if level is None:
+        return None
+    if level.isdigit():
+        return int(level)
+    if isinstance(levelno := log.getLevelName(level.upper()), int):
+        return levelno
+    raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Unknown level {level}")
+
+
+def _get_profile_session() -> profiling.Session:
+    if profiling.session is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    return profiling.session
+
+
+@api_router.post("/profile/", tags=["Profile"])
+async def start_profile(
+    body: ProfileRequestBody, auth=Depends(authenticate)
+) -> ProfileInfo:
+    """Start profiling. The result is at /profile/result once the session is over."""
+    getter = None
+    if body.getter is not None:
+        getter = _get_getter(body.getter)
+    try:
+        session = profiling.start(body.mode, body.seconds, getter)
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+    except RuntimeError as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+    return JSONResponse(
+        asdict(ProfileInfo.from_session(session)), status_code=status.HTTP_202_ACCEPTED
+    )
+
+
+@api_router.get("/profile/", tags=["Profile"])
+async def profile_info(
+    session: profiling.Session = Depends(_get_profile_session),
+    auth=Depends(authenticate),
+) -> ProfileInfo:
+    return ProfileInfo.from_session(session)
+
+
+@api_router.post("/profile/stop", tags=["Profile"])
+async def stop_profile(
+    session: profiling.Session = Depends(_get_profile_session),
+    auth=Depends(authenticate),
+) -> ProfileInfo:
+    await session.stop()
+    return ProfileInfo.from_session(session)
+
+
+@api_router.get("/profile/result", tags=["Profile"], response_class=PlainTextResponse)
+async def profile_result(
+    session: profiling.Session = Depends(_get_profile_session),
+    auth=Depends(authenticate),
+):
+    """pstats text for cprofile, collapsed stacks for sample, and allocation sites
+    for tracemalloc."""
+    if session.running:
+        raise HTTPException(status.HTTP_409_CONFLICT, "The session is still running")
+    if session.result is None:
+        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, session.error)
+    return PlainTextResponse(session.result)
+
+
 @api_router.get("/log/", tags=["Log"])
 async def list_log(
-    page: int = 0, page_size: int = 10, auth=Depends(authenticate)
+    page: int = 0,
+    page_size: int = 10,
+    level: Optional[str] = None,
+    logger: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    auth=Depends(authenticate),
 ) -> list[str]:
-    data_list = log.log_list
-    start_index = max(0, len(data_list) - (page + 1) * page_size)
-    end_index = len(data_list) - page * page_size
-    return data_list[start_index:end_index]
+    """The latest formatted log lines, oldest first. Page 0 holds the latest lines.
+
+    Only lines of at least level, from logger or its children, and logged at
+    since <= time < until are returned, if given.
+    """
+    entries = log.records.query(
+        level=_log_level(level),
+        name=logger,
+        since=since,
+        until=until,
+        limit=page_size,
+        offset=page * page_size,
+    )
+    return [str(entry) for entry in reversed(entries)]
+
+
+@api_router.get("/log/records", tags=["Log"])
+async def list_log_records(
+    level: Optional[str] = None,
+    logger: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = 100,
+    auth=Depends(authenticate),
+) -> list[log.LogEntry]:
+    """Structured log records, filtered like /log/.
+
+    Records are newest first, from before the sequence number before if given. With
+    after, records are oldest first from after the sequence number after, so polling
+    with the last seq received returns the records logged since.
+    """
+    return log.records.query(
+        level=_log_level(level),
+        name=logger,
+        since=since,
+        until=until,
+        before=before,
+        after=after,
+        limit=limit,
+    )
 
 
 def _get_task(task_id: str):
@@ -330,13 +682,15 @@ async def task_status(
 
 
 def _get_img(img_id):
-    img = store.ImageStorage.get_or_none(store.ImageStorage.id == img_id)
-    return img
+    if img := store.ImageStorage.get_or_none(store.ImageStorage.id == img_id):
+        return img
+    raise HTTPException(status.HTTP_404_NOT_FOUND)
 
 
 @res_router.get("/img/{img_id}", tags=["Image"])
 async def get_img(img: asyncio.Task = Depends(_get_img)) -> dict:
-    file_path = Path("data/pic") / img.filename
+    file_path = image.path / img.filename
+    image.touch(img.filename)
     return FileResponse(str(file_path.absolute()), media_type=img.mime)
 
 
@@ -0,0 +1,90 @@
+import re
+
+import log
+
+_REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+
+
+def _is_literal(rule: str) -> bool:
+    return _REGEX_METACHARACTERS.isdisjoint(rule)
+
+
+def _keywords_to_regex(keywords: list[str]) -> str:
+    """Build a regex matching any of keywords, with common prefixes merged into a trie.
+
+    At any position of the text, the regex engine then only follows the branch of
+    the current character instead of trying every keyword.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        end = "" in node
+        branches = [
+            re.escape(char) + build(node[char]) for char in sorted(node) if char
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not end:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")" + ("?" if end else "")
+
+    return build(trie)
+
+
+class BlockRules:
+    """policy.block_rules compiled for matching many texts.
+
+    A rule blocks a text if re.search(rule, text) finds it. Rules without regex
+    metacharacters are merged into a single keyword regex, so one pass over the text
+    tells whether any of them matches; the others are compiled once each.
+    """
+
+    def __init__(self, rules: list[str]) -> None:
+        self.rules = tuple(rules)
+        self._keywords: list[str] = []
+        self._patterns: list[tuple[str, re.Pattern]] = []
+
+        for rule in dict.fromkeys(self.rules):
+            if _is_literal(rule):
+                self._keywords.append(rule)
+                continue
+            try:
+                self._patterns.append((rule, re.compile(rule)))
+            except re.error as e:
+                log.warning(
+                    f'Block rule "{rule}" is not a valid regex: {e}. Used as keyword'
+                )
+                self._keywords.append(rule)
+
+        self._keywords_pattern = (
+            re.compile(_keywords_to_regex(self._keywords)) if self._keywords else None
+        )
+        self._order = {rule: i for i, rule in enumerate(dict.fromkeys(self.rules))}
+
+    def match(self, text: str) -> list[str]:
+        """Return the rules matching text, in configured order."""
+        matched = []
+        if self._keywords_pattern is not None and self._keywords_pattern.search(text):
+            matched.extend(keyword for keyword in self._keywords if keyword in text)
+        matched.extend(rule for rule, pattern in self._patterns if pattern.search(text))
+        if self._keywords and self._patterns:
+            matched.sort(key=self._order.__getitem__)
+        return matched
+
+
+_compiled = BlockRules([])
+
+
+def get_compiled(rules: list[str]) -> BlockRules:
+    """Return BlockRules for rules, compiling only when they changed since the last call."""
+    global _compiled
+    compiled = _compiled
+    if compiled.rules != tuple(rules):
+        compiled = BlockRules(rules)
+        _compiled = compiled
+    return compiled
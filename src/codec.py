@@ -0,0 +1,94 @@
+"""Compact binary encoding of Struct content, as stored in the database.
+
+An encoded Struct is a format byte followed by the msgpack encoded list of its
+elements, compressed if it is large. Each element is a list of its type tag and its
+field values in declaration order; fields holding elements are encoded the same way.
+Content stored as JSON, before this encoding, is still decoded.
+"""
+
+import json
+import zlib
+from dataclasses import fields
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import const
+from model.struct import (
+    Struct,
+    StructElement,
+    StructImage,
+    StructText,
+    StructTitle,
+    StructURL,
+)
+
+FORMAT_MSGPACK = 1
+FORMAT_MSGPACK_ZLIB = 2
+FORMAT_MSGPACK_ZSTD = 3
+
+# Tags are stored; never change or reuse one.
+TAGS: dict[type, int] = {
+    StructText: 0,
+    StructTitle: 1,
+    StructImage: 2,
+    StructURL: 3,
+}
+_types_by_tag = {tag: type_ for type_, tag in TAGS.items()}
+_field_names = {type_: [f.name for f in fields(type_)] for type_ in TAGS}
+
+if zstandard is not None:
+    _zstd_compressor = zstandard.ZstdCompressor()
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+
+
+def _encode_element(element: StructElement) -> list:
+    type_ = type(element)
+    encoded = [TAGS[type_]]
+    for name in _field_names[type_]:
+        value = getattr(element, name)
+        encoded.append(
+            _encode_element(value) if isinstance(value, StructElement) else value
+        )
+    return encoded
+
+
+def _decode_element(encoded: list) -> StructElement:
+    tag, *values = encoded
+    return _types_by_tag[tag](
+        *[_decode_element(v) if isinstance(v, list) else v for v in values]
+    )
+
+
+def encode(struct: Struct) -> bytes:
+    body = msgpack.packb([_encode_element(e) for e in struct.content])
+    if len(body) < const.STRUCT_COMPRESS_MINSIZE:
+        return bytes([FORMAT_MSGPACK]) + body
+    if zstandard is not None:
+        return bytes([FORMAT_MSGPACK_ZSTD]) + _zstd_compressor.compress(body)
+    return bytes([FORMAT_MSGPACK_ZLIB]) + zlib.compress(body)
+
+
+def decode(data: bytes | str) -> list[StructElement]:
+    """Decode the elements of a Struct encoded by encode, or stored as JSON."""
+    if isinstance(data, str):
+        return Struct(dict_=json.loads(data)).content
+
+    format, body = data[0], data[1:]
+    if format == FORMAT_MSGPACK:
+        pass
+    elif format == FORMAT_MSGPACK_ZLIB:
+        body = zlib.decompress(body)
+    elif format == FORMAT_MSGPACK_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to decode this content")
+        body = _zstd_decompressor.decompress(body)
+    elif data[:1] == b"[":
+        return Struct(dict_=json.loads(data)).content
+    else:
+        raise ValueError(f"Unknown Struct encoding {format}")
+    return [_decode_element(e) for e in msgpack.unpackb(body)]
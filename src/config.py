@@ -30,6 +30,9 @@ class HotReloadConfigManager(Generic[T]):
         self.type_ = config_type
         self.path = config_path
         self._rwlock = Lock()
+        self._cache_lock = Lock()
+        self._cache: tuple[tuple, T] | None = None
+        self.version = 0
         self._migrate_function = getattr(self.type_, "_migrate", None)
 
         if not self.path.exists():
@@ -80,6 +83,14 @@ class HotReloadConfigManager(Generic[T]):
     def save_yaml(self, config: str):
         with self._rwlock:
             self.path.write_text(config, "utf-8")
+            self._cache = None
+
+    def _stat(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
 
     @property
     def yaml(self) -> str:
@@ -101,12 +112,27 @@ class HotReloadConfigManager(Generic[T]):
 
     @property
     def value(self) -> T:
-        yaml_config = self.yaml
-        dict_config = yaml.safe_load(yaml_config)
-        config = HotReloadConfigManager._safe_from_dict(self.type_, dict_config)
-        if yaml.safe_dump(safe_asdict(config)) != yaml_config:
-            self.save(config)
-        return config
+        """Parsed config. It is only parsed again after the file changed,
+        so the returned object is shared and must not be modified."""
+        cache = self._cache
+        if cache is not None and cache[0] == self._stat():
+            return cache[1]
+
+        with self._cache_lock:
+            stat = self._stat()
+            cache = self._cache
+            if cache is not None and cache[0] == stat:
+                return cache[1]
+
+            yaml_config = self.yaml
+            dict_config = yaml.safe_load(yaml_config)
+            config = HotReloadConfigManager._safe_from_dict(self.type_, dict_config)
+            if yaml.safe_dump(safe_asdict(config)) != yaml_config:
+                self.save(config)
+                stat = self._stat()
+            self._cache = (stat, config)
+            self.version += 1
+            return config
 
     @property
     def jsonschema(self) -> T:
@@ -133,6 +159,13 @@ class MainConfig:
     @dataclass
     class LoggingConfig:
         verbose: bool = False
+        # data/log/root.log is rotated once it reaches file_max_mb or is older than
+        # file_rotate_hours (0 to rotate by size only). file_backup_count rotated
+        # files are kept. These take effect after restart.
+        file_max_mb: int = 10
+        file_rotate_hours: int = 0
+        file_backup_count: int = 10
+        file_format: str = "text"  # text or jsonl, one JSON object per line
 
     @dataclass
     class APIConfig:
@@ -152,6 +185,11 @@ class MainConfig:
         # This field will be passed directly to requests.request,
         # unless it is overwritten explicitly.
         proxies: dict[str, str] = field(default_factory=dict[str, str])
+        # Used by network.client(), the shared async HTTP client
+        timeout: float = 30  # seconds
+        retries: int = 3  # Retries of requests that failed to connect or are idempotent
+        max_connections: int = 100
+        max_connections_per_host: int = 10
 
     @dataclass
     class PolicyConfig:
@@ -167,6 +205,36 @@ class MainConfig:
         )
 
         perf_merged_details: bool = True
+        # Maximum number of concurrent detail fetches of a getter, which may be
+        # overridden by the getter's detail_concurrency, and of all getters together.
+        # The latter takes effect after restart.
+        detail_concurrency: int = 8
+        detail_global_concurrency: int = 32
+        # Pushes of an article to its pushers run concurrently. Each destination still
+        # receives articles one by one and in order.
+        push_timeout: float = 60  # seconds
+        push_class_concurrency: int = 4  # Per pusher class. Takes effect after restart.
+        # Failed pushes are retried with exponential backoff, up to delivery_max_attempts times.
+        delivery_max_attempts: int = 8
+        delivery_backoff_base: float = 30  # seconds
+        delivery_backoff_max: float = 3600  # seconds
+        # Number of long-lived event loops refreshes are spread over. Takes effect after restart.
+        # Getters on the same loop stall each other while one of them blocks, e.g. in
+        # requests or time.sleep. Getters calling requests get a loop of their own after
+        # their first refresh, which doesn't retry failed requests; set dedicated_loop in
+        # the config of other blocking ones.
+        perf_refresh_workers: int = 4
+
+    @dataclass
+    class ImageConfig:
+        # Downloaded images in data/pic are evicted, least recently used first, when
+        # they take more than max_size_mb together or weren't used for max_ageday days.
+        # 0 disables the respective limit.
+        max_size_mb: int = 10240
+        max_ageday: int = 0
+        clean_interval: int = 3600  # seconds
+        # Number of processes converting images. Takes effect after restart.
+        process_workers: int = 2
 
     pair: list[str] = field(
         default_factory=list[str]
@@ -176,6 +244,7 @@ class MainConfig:
     api: APIConfig = field(default_factory=APIConfig)
     network: NetworkConfig = field(default_factory=NetworkConfig)
     policy: PolicyConfig = field(default_factory=PolicyConfig)
+    image: ImageConfig = field(default_factory=ImageConfig)
 
     def _migrate(origin: dict):
         new = copy.deepcopy(origin)
@@ -1,3 +1,21 @@
 TASKLIST_MAXLENGTH = 200
 LOGLIST_MAXLENGTH = 8000
 PROXY_REQUEST_MAXRETRYTIME = 3
+HTTP_RETRY_BACKOFF = 0.5
+LOG_ARGUMENT_MAXLENGTH = 200
+OUTBOX_BATCHSIZE = 1000
+OUTBOX_POLL_INTERVAL = 60
+HTTP_CLIENT_CLOSE_DELAY = 60
+IMAGE_DOWNLOAD_CHUNKSIZE = 64 * 1024
+IMAGE_REVALIDATE_INTERVAL = 7 * 24 * 3600
+IMAGE_EVICTION_GRACE = 600
+DB_BUSY_TIMEOUT = 30
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_WRITE_BATCHSIZE = 500
+SEARCH_SNIPPET_LENGTH = 64  # Characters, at most 64
+STRUCT_COMPRESS_MINSIZE = 1024  # Bytes of encoded content to compress from
+REFRESH_HISTORY_MAXLENGTH = 200  # Per getter
+PROFILE_MAX_SECONDS = 600
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_RESULT_LIMIT = 100  # Functions or lines in a result, except collapsed stacks
+PROFILE_TRACEMALLOC_FRAMES = 10
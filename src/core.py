@@ -1,30 +1,84 @@
 import asyncio
-import concurrent
-import re
+import concurrent.futures
+import contextlib
+import json
+import random
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
 import aiocron
 import git
 
+import blockrule
 import config
+import const
+import engine
 import importing
+import metrics
 import network
 import store
 import task
+import tracing
 import util
 from model import *
 
 imported_adapter_classes: set[type] = set()
 registered_getters: list[Getter] = []
+# Indexes of the above by name
+imported_adapter_classes_by_name: dict[str, type] = {}
+registered_getters_by_name: dict[str, Getter] = {}
 
 # FIXME: if aiocron.crontab called in a different eventloop,
 # use this to specify which eventloop the corn uses.
 # If MessageSyncer run in a multi-threads mode, this will be useful.
 main_event_loop = None
 
+# Refreshes run on long-lived worker loops, so a blocking getter can't stall the API.
+# A getter is always refreshed on the same worker loop.
+refresh_pool = engine.LoopPool(
+    "refresh", lambda: _get_config().policy.perf_refresh_workers
+)
+# Pushers of a class live on a worker loop of the class's own and are kept between
+# pushes. So a class blocking its loop, e.g. in requests or time.sleep, only stalls
+# its own destinations. Few pusher classes are in use at once.
+_push_loops: dict[str, engine.WorkerLoop] = {}
+_push_loops_lock = threading.Lock()
+_pushers: dict[tuple[type, str | None], tuple[Pusher, asyncio.Future]] = {}
+# Limits detail fetches of all getters together
+_detail_semaphore: engine.ThreadSafeSemaphore | None = None
+# Like pushers, these live on the worker loop of their pusher class
+_class_semaphores: dict[str, asyncio.Semaphore] = {}
+_destination_locks: dict[str, asyncio.Lock] = {}
+
+_refresh_duration = metrics.histogram(
+    "messagesyncer_refresh_duration_seconds", "Duration of refreshes", ("getter",)
+)
+_refreshes = metrics.counter(
+    "messagesyncer_refreshes_total", "Refreshes by outcome", ("getter", "outcome")
+)
+_getter_call_duration = metrics.histogram(
+    "messagesyncer_getter_call_duration_seconds",
+    "Duration of list, detail and details calls of getters",
+    ("getter", "call"),
+)
+_refresh_new_articles = metrics.histogram(
+    "messagesyncer_refresh_new_articles",
+    "New articles found per refresh",
+    ("getter",),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+_push_duration = metrics.histogram(
+    "messagesyncer_push_duration_seconds",
+    "Duration of pushes, including failed ones",
+    ("pusher_class", "destination"),
+)
+_push_failures = metrics.counter(
+    "messagesyncer_push_failures_total",
+    "Failed pushes",
+    ("pusher_class", "destination"),
+)
+
 
 def _get_config():
     return config.main()
@@ -44,21 +98,269 @@ class AdapterNotFound(Exception): ...
 class AdapterClassNotImported(Exception): ...
 
 
-def _get_pusher(pusher) -> tuple[Pusher, dict]:
-    pusher_class, pusher_id, pusher_to = parse_pusher(pusher)
-    pusher_class = _get_or_import_class(pusher_class, adapter_classes_path)
-    return pusher_class(pusher_id), {"to": pusher_to}
+async def _get_pusher(pusher_class: type, pusher_id: str | None) -> Pusher:
+    """Return the started pusher instance of (pusher_class, pusher_id).
+    Must be called on the pusher class's worker loop, see push_loop."""
+    key = (pusher_class, pusher_id)
+    entry = _pushers.get(key)
+    if entry is None:
+        pusher = pusher_class(pusher_id)
+        entry = _pushers[key] = (pusher, asyncio.ensure_future(pusher.start()))
+        log.debug(f"{pusher} initialized")
+    pusher, started = entry
+    try:
+        await asyncio.shield(started)
+    except Exception:
+        if _pushers.get(key) is entry:
+            _pushers.pop(key)
+        raise
+    return pusher
+
+
+async def _close_pushers(class_name: str):
+    for key, (pusher, started) in list(_pushers.items()):
+        if key[0].__name__ != class_name:
+            continue
+        _pushers.pop(key)
+        try:
+            await started
+            await pusher.close()
+            log.debug(f"{pusher} closed")
+        except Exception as e:
+            log.warning(f"Failed to close {pusher}: {e}", exc_info=True)
+
+
+def push_loop(class_name: str) -> engine.WorkerLoop:
+    """The worker loop pushers of class_name live on."""
+    with _push_loops_lock:
+        if (worker := _push_loops.get(class_name)) is None:
+            worker = engine.WorkerLoop(f"push-{class_name}", shared=False)
+            worker.start()
+            _push_loops[class_name] = worker
+        return worker
+
+
+def close_pushers(class_name: str = None) -> list[concurrent.futures.Future]:
+    """Discard pooled pushers of class_name, or all of them, closing each on its loop."""
+    with _push_loops_lock:
+        loops = dict(_push_loops)
+    if class_name is None:
+        class_names = {key[0].__name__ for key in list(_pushers)}
+    else:
+        class_names = {class_name}
+    return [
+        asyncio.run_coroutine_threadsafe(_close_pushers(name), loops[name].loop)
+        for name in class_names
+        if name in loops
+    ]
+
+
+async def _push(route: "PusherRoute", content: Struct):
+    policy = _get_config().policy
+    class_name = route.pusher_class.__name__
+    if (class_semaphore := _class_semaphores.get(class_name)) is None:
+        class_semaphore = _class_semaphores[class_name] = asyncio.Semaphore(
+            policy.push_class_concurrency
+        )
+    if (destination_lock := _destination_locks.get(route.pusher)) is None:
+        destination_lock = _destination_locks[route.pusher] = asyncio.Lock()
+
+    # The lock is taken first and in FIFO order, so a destination receives
+    # contents in the order they were pushed to it.
+    async with contextlib.AsyncExitStack() as stack:
+        with tracing.span("push.wait"):
+            await stack.enter_async_context(destination_lock)
+            await stack.enter_async_context(class_semaphore)
+        with tracing.span("push.connect"):
+            pusher = await _get_pusher(route.pusher_class, route.pusher_id)
+        preview_str = content.as_preview_str()
+        hash_ = content.digest[:12]
+
+        logger = log.getLogger("push")
+        logger.debug(f"{pusher}: {hash_}: start: {preview_str}")
+        labels = (class_name, route.pusher)
+        try:
+            with tracing.span("push.send") as send, _push_duration.time(*labels):
+                await asyncio.wait_for(
+                    pusher.push(content, to=route.to), policy.push_timeout
+                )
+        except BaseException:
+            _push_failures.inc(*labels)
+            raise
+        logger.debug(f"{pusher}: {hash_}: finished after {send.duration:.3f}s")
 
 
-async def push_to(pusher, content: Struct):
-    pusher, detail = _get_pusher(pusher)
-    preview_str = content.as_preview_str()
-    hash_ = hash(content)
+async def push_to(pusher: "str | PusherRoute", content: Struct):
+    route = pusher if isinstance(pusher, PusherRoute) else _parse_route(pusher)
+    await push_loop(route.pusher_class.__name__).run(_push(route, content))
 
-    logger = log.getLogger("push")
-    logger.debug(f"{pusher}: {hash_}: start: {preview_str}")
-    await pusher.push(content, **detail)
-    logger.debug(f"{pusher}: {hash_}: finished")
+
+async def dispatch(
+    pushers: "list[str | PusherRoute]", content: Struct
+) -> list[tuple["str | PusherRoute", BaseException | None]]:
+    """Push content to all pushers concurrently. Return the exception of each push."""
+    results = await asyncio.gather(
+        *[push_to(pusher, content) for pusher in pushers], return_exceptions=True
+    )
+    return list(zip(pushers, results))
+
+
+# Deliveries of new articles are recorded in store.Outbox before they are pushed,
+# and retried with backoff until they succeed or run out of attempts.
+# If the delivery worker isn't running, deliver() pushes them directly.
+_delivery_worker: asyncio.Task | None = None
+_delivery_wakeup: asyncio.Event | None = None
+_delivery_loop: asyncio.AbstractEventLoop | None = None
+# Destinations whose entries are being delivered by the worker
+_delivering: dict[str, asyncio.Task] = {}
+
+
+def _delivery_backoff(attempts: int) -> float:
+    policy = _get_config().policy
+    delay = min(
+        policy.delivery_backoff_max, policy.delivery_backoff_base * 2 ** (attempts - 1)
+    )
+    return delay * random.uniform(0.5, 1.5)
+
+
+async def _deliver(entry: store.Outbox) -> bool:
+    """Try to deliver entry once. Return False if it's scheduled for a retry."""
+    logger = log.getLogger("delivery")
+    max_attempts = _get_config().policy.delivery_max_attempts
+    article = store.Article.get_or_none(store.Article.id == entry.article)
+    refresh_trace = tracing.current.get()
+    try:
+        # An attempt has a trace of its own, as the delivery worker makes most of
+        # them outside of any refresh. Within one, its stages count there too.
+        with tracing.trace(entry.pusher, tracing.DELIVERY) as attempt:
+            try:
+                if article is None:
+                    raise Exception(f"article {entry.article} not found")
+                await push_to(entry.pusher, article.content)
+            finally:
+                if refresh_trace is not None:
+                    for stage, duration in attempt.stages.items():
+                        refresh_trace.add(stage, duration)
+    except Exception as e:
+        entry.attempts += 1
+        entry.last_error = f"{type(e).__name__}: {e}"
+        entry.last_attempt_duration = attempt.duration
+        entry.last_attempt_stages = json.dumps(attempt.stages)
+        if article is None or entry.attempts >= max_attempts:
+            entry.state = store.Outbox.DEAD
+            await store.write_async(entry.save)
+            logger.error(
+                f"failed to push {entry.article} to {entry.pusher} after {entry.attempts} attempts: {e}",
+                exc_info=e,
+            )
+            content = article.content if article else ""
+            await warning(
+                Struct().text(f"Failed to push to {entry.pusher}: \n{content}\n: {e}")
+            )
+            return True
+
+        delay = _delivery_backoff(entry.attempts)
+        entry.next_attempt_ts = time.time() + delay
+        await store.write_async(entry.save)
+        logger.warning(
+            f"failed to push {entry.article} to {entry.pusher} ({entry.attempts}/{max_attempts}): {e}. Retry in {delay:.0f}s"
+        )
+        return False
+
+    await store.write_async(entry.delete_instance)
+    logger.debug(f"{entry.article} delivered to {entry.pusher}")
+    return True
+
+
+async def _deliver_in_order(entries: list[store.Outbox]):
+    """Deliver entries of one destination in order, stopping at the first one to retry."""
+    for entry in entries:
+        if not await _deliver(entry):
+            break
+
+
+async def deliver(entries: list[store.Outbox]):
+    """Deliver entries now, or leave them to the delivery worker if it's running."""
+    if _delivery_worker is not None and not _delivery_worker.done():
+        wake_delivery_worker()
+        return
+    by_destination: dict[str, list[store.Outbox]] = {}
+    for entry in entries:
+        by_destination.setdefault(entry.pusher, []).append(entry)
+    await asyncio.gather(*[_deliver_in_order(e) for e in by_destination.values()])
+
+
+def _deliver_due() -> float | None:
+    """Start delivering pending entries which are due, one task per destination.
+    Return when the next waiting entry is due."""
+    now = time.time()
+    due: dict[str, list[store.Outbox]] = {}
+    next_due = None
+
+    # Only the first entry of a destination can be waiting for a retry; the later
+    # ones wait for it, to keep the order. So destinations are picked by their first
+    # entry, and one with many entries waiting can't crowd out the others.
+    for head in store.outbox_heads():
+        if head.pusher in _delivering:
+            continue
+        if head.next_attempt_ts > now:
+            next_due = min(next_due or head.next_attempt_ts, head.next_attempt_ts)
+            continue
+        for entry in store.pending_outbox_entries(head.pusher, const.OUTBOX_BATCHSIZE):
+            if entry.next_attempt_ts > now:
+                break
+            due.setdefault(entry.pusher, []).append(entry)
+
+    for pusher, entries in due.items():
+        task = asyncio.create_task(_deliver_in_order(entries))
+        _delivering[pusher] = task
+
+        def _done(task, pusher=pusher):
+            _delivering.pop(pusher, None)
+            wake_delivery_worker()
+
+        task.add_done_callback(_done)
+    return next_due
+
+
+async def _run_delivery_worker():
+    while True:
+        _delivery_wakeup.clear()
+        try:
+            next_due = _deliver_due()
+        except Exception as e:
+            log.error(f"Delivery worker failed: {e}", exc_info=True)
+            next_due = None
+
+        timeout = const.OUTBOX_POLL_INTERVAL
+        if next_due is not None:
+            timeout = min(timeout, max(0, next_due - time.time()))
+        try:
+            await asyncio.wait_for(_delivery_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_delivery_worker():
+    """Start draining store.Outbox on the running loop."""
+    global _delivery_worker, _delivery_wakeup, _delivery_loop
+    _delivery_loop = asyncio.get_running_loop()
+    _delivery_wakeup = asyncio.Event()
+    _delivery_worker = asyncio.create_task(_run_delivery_worker())
+
+
+def wake_delivery_worker():
+    """Let the delivery worker check for due entries now. May be called from any thread."""
+    if _delivery_loop is not None and not _delivery_loop.is_closed():
+        _delivery_loop.call_soon_threadsafe(_delivery_wakeup.set)
+
+
+def requeue_delivery(entry: store.Outbox):
+    entry.state = store.Outbox.PENDING
+    entry.attempts = 0
+    entry.next_attempt_ts = 0
+    store.write(entry.save)
+    wake_delivery_worker()
 
 
 def adapter_type_is(adapter: type, type_: type):
@@ -73,6 +375,7 @@ def register_getter(getter: Getter):
     if _get_config().policy.refresh_when_start:
         asyncio.create_task(refresh(getter))
     registered_getters.append(getter)
+    registered_getters_by_name[getter.name] = getter
     log.debug(f"Getter registered: {getter}")
 
 
@@ -80,6 +383,8 @@ def unregister_getter(getter: Getter):
     for trigger in list(getter._triggers.keys()):
         unregister_corn(getter, trigger)
     registered_getters.remove(getter)
+    if registered_getters_by_name.get(getter.name) is getter:
+        registered_getters_by_name.pop(getter.name)
     log.debug(f"Getter unregistered: {getter}")
 
 
@@ -127,12 +432,16 @@ def stop_corn(getter: Getter, trigger: str):
 
 
 def reload_adapter_class(curclass: type):
+    global _adapter_generation
     name = curclass.__name__
     imported_adapter_classes.remove(curclass)
+    imported_adapter_classes_by_name.pop(name, None)
     newclass = importing.from_package_import_attr(
         name, adapter_classes_path / name, name, force_reload=True
     )
-    imported_adapter_classes.add(newclass)
+    _add_imported_class(newclass)
+    _adapter_generation += 1
+    close_pushers(name)
     if adapter_type_is(newclass, Getter):
         for getter in registered_getters.copy():
             if getter.class_name == name:
@@ -159,70 +468,149 @@ def uninstall_adapter(name: str):
     path.unlink(True)
 
 
-def _get_or_import_class(class_name: str, path: Path) -> type:
+def _add_imported_class(cls: type):
+    imported_adapter_classes.add(cls)
+    imported_adapter_classes_by_name[cls.__name__] = cls
+
+
+def find_imported_class(class_name: str) -> type | None:
+    if cls := imported_adapter_classes_by_name.get(class_name):
+        return cls
+    # Classes may also be added to imported_adapter_classes directly
     if matched := [
         cls for cls in imported_adapter_classes if cls.__name__ == class_name
     ]:
+        imported_adapter_classes_by_name[class_name] = matched[0]
         return matched[0]
+    return None
+
+
+def _get_or_import_class(class_name: str, path: Path) -> type:
+    if cls := find_imported_class(class_name):
+        return cls
     else:
         cls = importing.from_package_import_attr(
             class_name,
             path / class_name,
             class_name,
         )
-        imported_adapter_classes.add(cls)
+        _add_imported_class(cls)
         return cls
 
 
+def _parse_pair(pair_str: str):
+    getter_str, pusher_str = pair_str.split(" ", 1)
+    getter_class_name, getter_id = parse_getter(getter_str)
+    pusher_class_name, _, _ = parse_pusher(pusher_str)
+
+    getter_class = _get_or_import_class(getter_class_name, adapter_classes_path)
+    pusher_class = _get_or_import_class(pusher_class_name, adapter_classes_path)
+    return getter_str, getter_class, getter_id, pusher_str, pusher_class
+
+
 def _parse_pairs():
     result: dict[Getter, list[str]] = {}
+    initialized: dict[str, Getter] = {}
     for pair_str in _get_config().pair:
         try:
-            getter_str, pusher_str = pair_str.split(" ", 1)
-            getter_class_name, getter_id = parse_getter(getter_str)
-            pusher_class_name, _, _ = parse_pusher(pusher_str)
-
-            getter_class = _get_or_import_class(getter_class_name, adapter_classes_path)
-            pusher_class = _get_or_import_class(pusher_class_name, adapter_classes_path)
+            getter_str, getter_class, getter_id, pusher_str, _ = _parse_pair(pair_str)
         except Exception as e:
             log.warning(f"Failed to parse {pair_str}: {e}. Skipped", exc_info=True)
             continue
 
-        if matched := [
-            getter for getter in registered_getters if getter.name == getter_str
-        ]:
-            getter = matched[0]
-        elif matched := [getter for getter in result if getter.name == getter_str]:
-            getter = matched[0]
-        else:
+        getter = registered_getters_by_name.get(getter_str) or initialized.get(
+            getter_str
+        )
+        if getter is None:
             getter = getter_class(getter_id)
+            initialized[getter_str] = getter
             log.debug(f"{getter} initialized")
 
         result.setdefault(getter, []).append(pusher_str)
     return result
 
 
+@dataclass
+class PusherRoute:
+    pusher: str
+    pusher_class: type
+    pusher_id: str | None
+    to: str | None
+
+
+# Bumped whenever adapter classes are reloaded, to rebuild what depends on them
+_adapter_generation = 0
+# ((pairs, _adapter_generation), routing table by getter name)
+_routing: tuple[tuple, dict[str, list[PusherRoute]]] = ((), {})
+
+
+def _parse_route(pusher_str: str) -> PusherRoute:
+    pusher_class_name, pusher_id, pusher_to = parse_pusher(pusher_str)
+    pusher_class = _get_or_import_class(pusher_class_name, adapter_classes_path)
+    return PusherRoute(pusher_str, pusher_class, pusher_id, pusher_to)
+
+
+def _build_routing_table(pairs: list[str]) -> dict[str, list[PusherRoute]]:
+    routes: dict[str, list[PusherRoute]] = {}
+    for pair_str in pairs:
+        try:
+            getter_str, _, _, pusher_str, _ = _parse_pair(pair_str)
+            route = _parse_route(pusher_str)
+        except Exception as e:
+            log.warning(f"Failed to parse {pair_str}: {e}. Skipped", exc_info=True)
+            continue
+        routes.setdefault(getter_str, []).append(route)
+    return routes
+
+
+def get_routes(getter: Getter) -> list[PusherRoute]:
+    """Pushers paired with getter. The routing table is only rebuilt
+    when pairs changed or adapter classes were reloaded."""
+    global _routing
+    pairs = _get_config().pair
+    key = (tuple(pairs), _adapter_generation)
+    routing_key, routes = _routing
+    if routing_key != key:
+        routes = _build_routing_table(pairs)
+        _routing = (key, routes)
+        log.debug(f"Routing table rebuilt: {len(routes)} getters")
+    return routes.get(getter.name, [])
+
+
+async def shutdown():
+    if _delivery_worker is not None:
+        _delivery_worker.cancel()
+    for future in close_pushers():
+        await asyncio.wrap_future(future)
+    refresh_pool.stop()
+    with _push_loops_lock:
+        while _push_loops:
+            _push_loops.popitem()[1].stop()
+    while _dedicated_loops:
+        _dedicated_loops.popitem()[1].stop()
+    await network.close_clients()
+    await asyncio.to_thread(store.writer.stop)
+
+
 def update_getters():
     pairs_details = _parse_pairs()
+    pairs_getters = {getter.name for getter in pairs_details}
     removed = []
     added = []
-    for getter in registered_getters:
-        if getter not in pairs_details:
+    for getter in registered_getters.copy():
+        if getter.name not in pairs_getters:
             unregister_getter(getter)
             removed.append(getter)
     for getter in pairs_details:
-        if getter not in registered_getters:
+        if getter.name not in registered_getters_by_name:
             register_getter(getter)
             added.append(getter)
 
 
 async def warning(content: Struct):
-    try:
-        pushto = _get_config().warning.to
-        for pusher in pushto:
-            await push_to(pusher, content)
-    except Exception as e:
-        log.fatal(f"Failure to issue alarm: {e}", exc_info=True)
+    for pusher, e in await dispatch(_get_config().warning.to, content):
+        if e is not None:
+            log.fatal(f"Failure to issue alarm: {e}", exc_info=e)
 
 
 @dataclass
@@ -237,20 +625,51 @@ async def _trigger_refresh(getter: Getter):
     task.create_task(refresh(getter))
 
 
+# Loops of getters which block, by name. See PolicyConfig.perf_refresh_workers.
+_dedicated_loops: dict[str, engine.WorkerLoop] = {}
+
+
+def refresh_loop(getter: Getter) -> engine.WorkerLoop:
+    """The worker loop getter refreshes on."""
+    dedicated = getattr(getter.config, "dedicated_loop", False)
+    if not dedicated and getter.name not in network.blocking_callers:
+        return refresh_pool.pick(getter.name)
+    if (worker := _dedicated_loops.get(getter.name)) is None:
+        worker = engine.WorkerLoop(f"refresh-{getter.name}", shared=False)
+        worker.start()
+        _dedicated_loops[getter.name] = worker
+    return worker
+
+
 async def refresh(getter: Getter) -> RefreshResult:
     update_trigger(getter)
+    network.install_proxies_patch()
+    return await refresh_loop(getter).run(refresh_worker(getter))
 
-    async def thread_worker():
-        with network.force_proxies_patch():
-            result_data = await refresh_worker(getter)
-            return result_data
 
-    loop = asyncio.get_event_loop()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        result = await loop.run_in_executor(
-            executor, lambda: asyncio.run(thread_worker())
+async def _save_refresh_history(trace_: tracing.Trace, outcome: str, error: str):
+    try:
+        await store.write_async(
+            store.save_refresh_history,
+            trace_.name,
+            trace_.start_ts,
+            trace_.duration,
+            outcome,
+            error,
+            trace_.stages,
+            trace_.counts,
         )
-    return result
+    except Exception as e:
+        log.error(f"{trace_.name}: failed to save refresh history: {e}", exc_info=e)
+
+
+def _get_detail_semaphore() -> engine.ThreadSafeSemaphore:
+    global _detail_semaphore
+    if _detail_semaphore is None:
+        _detail_semaphore = engine.ThreadSafeSemaphore(
+            _get_config().policy.detail_global_concurrency
+        )
+    return _detail_semaphore
 
 
 async def refresh_worker(getter: Getter) -> RefreshResult:
@@ -263,137 +682,173 @@ async def refresh_worker(getter: Getter) -> RefreshResult:
         return []
 
     getter._working = True
+    outcome, error = store.RefreshHistory.SUCCESS, None
 
-    new_articles_during_fresh = []
-    try:
-
-        def article_already_exists(id_):
-            if store.Article.get_or_none(store.Article.id == id_):
-                logger.debug(f"{getter}: {id_} exists. Passed")
-                return True
-            logger.info(f"{getter}: got new article: {id_}")
-            return False
-
-        list_ = await getter.list()
-        logger.debug(f"{getter}: got latest list: {list_}")
-        list_ = [
-            prefix + id_ for id_ in list_ if not article_already_exists(prefix + id_)
-        ]
-
-        if list_:
-
-            async def process_result(id_: str, result: GetResult):
-                new_articles_during_fresh.append(
-                    RefreshResultSingle(
-                        result.user_id, result.ts, result.content.asdict()
-                    )
-                )
-                content = result.content
-                content_text = str(content)
-                # logger.info(content_text)
-
-                push = True
-                push_passed_reason = []
+    with tracing.trace(getter.name, tracing.REFRESH) as trace_:
+        new_articles_during_fresh = []
+        try:
 
-                if getter._first:
-                    if _get_config().policy.skip_first:
-                        push = False
-                        push_passed_reason.append("skip_first")
+            with tracing.span("list"), _getter_call_duration.time(getter.name, "list"):
+                list_ = await getter.list()
+            logger.debug(f"{getter}: got latest list: {list_}")
+            ids = list(dict.fromkeys(prefix + id_ for id_ in list_))
 
-                for rule in _get_config().policy.block_rules:
-                    if re.match(rule, content_text) or re.search(rule, content_text):
+            # Only ids not seen in the previous list need a lookup, which is one query.
+            unknown_ids = [id_ for id_ in ids if id_ not in getter._seen_ids]
+            with tracing.span("lookup"):
+                existing_ids = (
+                    store.existing_article_ids(unknown_ids) if unknown_ids else set()
+                )
+            getter._seen_ids = {
+                id_ for id_ in ids if id_ in getter._seen_ids or id_ in existing_ids
+            }
+            list_ = [id_ for id_ in ids if id_ not in getter._seen_ids]
+            logger.debug(f"{getter}: {len(ids) - len(list_)} exist. Passed")
+            for id_ in list_:
+                logger.info(f"{getter}: got new article: {id_}")
+            tracing.count("listed", len(ids))
+            tracing.count("new", len(list_))
+
+            if list_:
+
+                async def process_result(id_: str | list[str], result: GetResult):
+                    content = result.content
+                    content_text = str(content)
+                    # logger.info(content_text)
+
+                    push = True
+                    push_passed_reason = []
+                    policy = _get_config().policy
+
+                    if getter._first:
+                        if policy.skip_first:
+                            push = False
+                            push_passed_reason.append("skip_first")
+
+                    for rule in blockrule.get_compiled(policy.block_rules).match(
+                        content_text
+                    ):
                         push = False
                         push_passed_reason.append(f'block_rule "{rule}"')
 
-                if (
-                    time.time() - result.ts
-                ) / 3600 / 24 > _get_config().policy.article_max_ageday:
-                    push = False
-                    push_passed_reason.append("exceed article_max_ageday")
-
-                if push:
-                    for push_detail in _parse_pairs()[getter]:
-                        try:
-                            await push_to(push_detail, content)
-                        except Exception as e:
-                            logger.error(
-                                f"{getter}: failed to push {id_} to {push_detail}: {e}",
-                                exc_info=True,
-                            )
-                            await warning(
-                                Struct().text(
-                                    f"Failed to push to {push_detail}: \n{content}\n: {e}"
-                                )
+                    if (
+                        time.time() - result.ts
+                    ) / 3600 / 24 > policy.article_max_ageday:
+                        push = False
+                        push_passed_reason.append("exceed article_max_ageday")
+
+                    pushers = []
+                    if push:
+                        pushers = [route.pusher for route in get_routes(getter)]
+                    else:
+                        logger.debug(
+                            "{}: skipped to push {} because: {}".format(
+                                getter, id_, ", ".join(push_passed_reason)
                             )
-                else:
-                    logger.debug(
-                        "{}: skipped to push {} because: {}".format(
-                            getter, id_, ", ".join(push_passed_reason)
                         )
-                    )
 
-            async def process_fault(id_, e):
-                logger.error(
-                    f"{getter}: failed to get detail of {id_}: {e}", exc_info=True
-                )
-                await warning(
-                    Struct().text(f"{getter} failed to get detail of {id_}: {e}")
-                )
+                    # A merged detail is delivered once, as its first id.
+                    ids = id_ if isinstance(id_, list) else [id_]
+                    deliveries = await get_or_create_article(ids[0], result, pushers)
+                    for _id in ids[1:]:
+                        await get_or_create_article(_id, result)
+                    new_articles_during_fresh.append(
+                        RefreshResultSingle(
+                            result.user_id, result.ts, result.content.asdict()
+                        )
+                    )
+                    tracing.count("articles")
+                    if deliveries:
+                        tracing.count("deliveries", len(deliveries))
+                        with tracing.span("deliver"):
+                            await deliver(deliveries)
+
+                async def process_fault(id_, e):
+                    tracing.count("detail_failures")
+                    logger.error(
+                        f"{getter}: failed to get detail of {id_}: {e}", exc_info=True
+                    )
+                    await warning(
+                        Struct().text(f"{getter} failed to get detail of {id_}: {e}")
+                    )
 
-            def get_or_create_article(id_, detail):
-                _article = store.Article.get_or_none(store.Article.id == id_)
-                if not _article:
-                    article = store.Article.from_getresult(id_, detail)
-                    article.save(force_insert=True)
+                async def get_or_create_article(id_, detail, pushers=[]):
+                    with tracing.span("store"):
+                        deliveries = await store.write_async(
+                            store.save_article, id_, detail, pushers
+                        )
+                    getter._seen_ids.add(id_)
+                    return deliveries
 
-            use_merged = _get_config().policy.perf_merged_details
+                use_merged = _get_config().policy.perf_merged_details
 
-            if use_merged:
-                try:
-                    detail = await getter.details(
-                        [id_.removeprefix(prefix) for id_ in list_]
-                    )
-                    detail.user_id = prefix + detail.user_id
-                    [get_or_create_article(_id, detail) for _id in list_]
-                    await process_result(list_, detail)
-                except NotImplementedError:
-                    use_merged = False
-                except Exception as e:
-                    await process_fault(list_, e)
-
-            if not use_merged:
-                works = []
-
-                async def _process_signal_article(id_: str):
+                if use_merged:
                     try:
-                        detail = await getter.detail(id_.removeprefix(prefix))
+                        with tracing.span("details"), _getter_call_duration.time(
+                            getter.name, "details"
+                        ):
+                            detail = await getter.details(
+                                [id_.removeprefix(prefix) for id_ in list_]
+                            )
                         detail.user_id = prefix + detail.user_id
-                        get_or_create_article(id_, detail)
-                        await process_result(id_, detail)
+                        await process_result(list_, detail)
+                    except NotImplementedError:
+                        use_merged = False
                     except Exception as e:
-                        await process_fault(id_, e)
+                        await process_fault(list_, e)
 
-                for id_ in list_:
-                    works.append(_process_signal_article(id_))
-                await asyncio.gather(*works)
+                if not use_merged:
+                    works = []
+                    global_semaphore = _get_detail_semaphore()
+                    detail_concurrency = getattr(
+                        getter.config, "detail_concurrency", None
+                    )
+                    if detail_concurrency is None:
+                        detail_concurrency = _get_config().policy.detail_concurrency
+                    getter_semaphore = asyncio.Semaphore(detail_concurrency)
 
-        getter._consecutive_failures_number = 0
-        getter._first = False
-        logger.debug(f"{getter}: finished")
-    except Exception as e:
-        logger.error(f"{getter}: failed: {e}", exc_info=True)
+                    async def _process_signal_article(id_: str):
+                        try:
+                            async with getter_semaphore, global_semaphore:
+                                with tracing.span("detail"), _getter_call_duration.time(
+                                    getter.name, "detail"
+                                ):
+                                    detail = await getter.detail(
+                                        id_.removeprefix(prefix)
+                                    )
+                            detail.user_id = prefix + detail.user_id
+                            # Each result goes on as soon as it's fetched
+                            await process_result(id_, detail)
+                        except Exception as e:
+                            await process_fault(id_, e)
 
-        getter._consecutive_failures_number += 1
-        if (
-            getter._consecutive_failures_number
-            in _get_config().warning.consecutive_getter_failures_number_to_trigger_warning
-        ):
-            await warning(
-                Struct().text(
-                    f"""{getter} failed to get the latest list after {getter._consecutive_failures_number} consecutive attempts.
+                    for id_ in list_:
+                        works.append(_process_signal_article(id_))
+                    await asyncio.gather(*works)
+
+            getter._consecutive_failures_number = 0
+            getter._first = False
+            logger.debug(f"{getter}: finished")
+            _refreshes.inc(getter.name, "success")
+            _refresh_new_articles.observe(len(new_articles_during_fresh), getter.name)
+        except Exception as e:
+            logger.error(f"{getter}: failed: {e}", exc_info=True)
+            _refreshes.inc(getter.name, "failure")
+            outcome, error = store.RefreshHistory.FAILURE, repr(e)
+
+            getter._consecutive_failures_number += 1
+            if (
+                getter._consecutive_failures_number
+                in _get_config().warning.consecutive_getter_failures_number_to_trigger_warning
+            ):
+                await warning(
+                    Struct().text(
+                        f"""{getter} failed to get the latest list after {getter._consecutive_failures_number} consecutive attempts.
 Latest Exception: {e}"""
+                    )
                 )
-            )
 
     getter._working = False
+    _refresh_duration.observe(trace_.duration, getter.name)
+    await _save_refresh_history(trace_, outcome, error)
     return new_articles_during_fresh
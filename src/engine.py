@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import zlib
+from collections import deque
+from itertools import count
+from typing import Callable, Coroutine
+
+import log
+
+_local = threading.local()
+
+
+def current_worker() -> "WorkerLoop | None":
+    """The worker loop running in this thread, if any."""
+    return getattr(_local, "worker", None)
+
+
+class WorkerLoop:
+    """An event loop running forever in its own daemon thread.
+
+    A loop is shared if it runs coroutines of several callers, which then stall
+    each other while one of them blocks.
+    """
+
+    def __init__(self, name: str, shared: bool = True) -> None:
+        self.name = name
+        self.shared = shared
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._ready = threading.Event()
+
+    def _run(self):
+        _local.worker = self
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def start(self):
+        self.thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def run(self, coro: Coroutine):
+        """Run coro on this loop and wait for its result.
+
+        If the caller already runs on this loop, coro is awaited directly.
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            return await coro
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return await asyncio.wrap_future(future)
+
+
+class LoopPool:
+    """A fixed number of long-lived worker loops.
+
+    Coroutines submitted with the same key always run on the same loop, so state
+    bound to a loop (sessions, locks, ...) can be kept between runs. A coroutine that
+    blocks only stalls its own worker loop, never the caller's loop.
+    """
+
+    def __init__(self, name: str, size: int | Callable[[], int] = 4) -> None:
+        self.name = name
+        self._size = size
+        self._workers: list[WorkerLoop] = []
+        self._lock = threading.Lock()
+        self._round_robin = count()
+        self.logger = log.getLogger(f"engine.{name}")
+
+    @property
+    def started(self):
+        return bool(self._workers)
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+            size = self._size() if callable(self._size) else self._size
+            size = max(1, int(size))
+            workers = [WorkerLoop(f"{self.name}-{i}") for i in range(size)]
+            for worker in workers:
+                worker.start()
+            self._workers = workers
+        self.logger.debug(f"started with {size} worker loops")
+
+    def stop(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+        if workers:
+            self.logger.debug("stopped")
+
+    def pick(self, key: str = None) -> WorkerLoop:
+        if not self._workers:
+            self.start()
+        workers = self._workers
+        if key is None:
+            index = next(self._round_robin)
+        else:
+            index = zlib.crc32(key.encode())
+        return workers[index % len(workers)]
+
+    async def run(self, coro: Coroutine, key: str = None):
+        """Run coro on the worker loop owning key and wait for its result.
+
+        If the caller already runs on that loop, coro is awaited directly.
+        """
+        return await self.pick(key).run(coro)
+
+
+class ThreadSafeSemaphore:
+    """A semaphore shared by coroutines running on different event loops."""
+
+    def __init__(self, value: int) -> None:
+        self._value = value
+        self._lock = threading.Lock()
+        self._waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        future = waiter[1]
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            # Granted, but cancelled before resuming
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    # The waiter's loop is closed
+                    continue
+            self._value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
@@ -1,14 +1,29 @@
 import asyncio
 import base64
+import concurrent.futures
+import inspect
+import mimetypes
+import multiprocessing
 import random
+import re
+import shutil
 import string
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
 from hashlib import sha256
 from pathlib import Path
 from typing import Callable
 from urllib.parse import urlparse
 
-from PIL import Image
+from peewee import fn
 
+import config
+import const
+import imageproc
+import log
+import network
 import store
 import util
 from model.struct import StructImage
@@ -18,15 +33,26 @@ path.mkdir(parents=True, exist_ok=True)
 
 
 async def download_list(
-    ls: list[str], after_download_hook: Callable[[str, str, bool], str] = None
+    ls: list[str],
+    after_download_hook: Callable[[str, str, bool], str] = None,
+    operation: "ImageOperation" = None,
 ) -> list[str]:
+    """Download the images at ls, converted with operation if given.
+
+    after_download_hook(url, path, downloaded) may return another path to use. If it
+    is a coroutine function it is awaited, otherwise it runs in a thread.
+    """
     pics = {p: None for p in ls}
     works = []
 
     async def process_picture(picurl):
         try:
             path, downloaded = await download_withcache(picurl)
-            if after_download_hook:
+            if operation is not None:
+                path = await convert(path, operation)
+            if inspect.iscoroutinefunction(after_download_hook):
+                path = await after_download_hook(picurl, path, downloaded)
+            elif after_download_hook:
                 path = await asyncio.threads.to_thread(
                     after_download_hook, *(picurl, path, downloaded)
                 )
@@ -48,39 +74,531 @@ def image_to_base64(image_path):
         return base64_data
 
 
-def webp2png(path: Path):
-    # starttime = time.time()
-    temp_path = Path(path.parent / "_webp2png_temp_" + path.name)
-    webp = Image.open(path)
-    webp.save(temp_path, "png", save_all=True, optimize=True)
+@dataclass(frozen=True)
+class ImageOperation:
+    """A conversion of an image. Fields left None keep the source's."""
+
+    format: str = None  # PIL format name, e.g. "PNG", "JPEG", "WEBP"
+    max_width: int = None
+    max_height: int = None
+    quality: int = None
+    optimize: bool = False
+
+    @property
+    def key(self) -> str:
+        return ",".join(
+            f"{name}={value}"
+            for name, value in asdict(self).items()
+            if value is not None and value is not False
+        )
+
+    @property
+    def max_size(self) -> tuple[int, int] | None:
+        if self.max_width is None and self.max_height is None:
+            return None
+        return (self.max_width or 1 << 16, self.max_height or 1 << 16)
+
+
+_FORMAT_SUFFIXES = {"JPEG": ".jpg"}
+
+_process_pool: concurrent.futures.ProcessPoolExecutor | None = None
+_process_pool_lock = threading.Lock()
+
+# Conversions in progress by (source digest, operation key)
+_conversions: dict[tuple[str, str], concurrent.futures.Future] = {}
+_conversions_lock = threading.Lock()
+
+
+def _get_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(1, config.main().image.process_workers),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+
+def _stored_filename(file: Path) -> str | None:
+    """file relative to data/pic, if it's in there."""
     try:
-        path.unlink(True)
-        temp_path.rename(path)
-        return path
-    except Exception as e:
-        return temp_path
+        return file.absolute().relative_to(path.absolute()).as_posix()
+    except ValueError:
+        return None
+
+
+def _source_digest(source: Path) -> str:
+    if (filename := _stored_filename(source)) is not None:
+        if image_file := store.ImageFile.get_or_none(
+            store.ImageFile.filename == filename
+        ):
+            touch(filename)
+            return image_file.digest
+    return _file_digest(source)
+
+
+def _file_digest(file: Path) -> str:
+    hash_ = sha256()
+    with file.open("rb") as f:
+        while chunk := f.read(const.IMAGE_DOWNLOAD_CHUNKSIZE):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _convert(source: Path, digest: str, operation: ImageOperation) -> Path:
+    if operation.format:
+        format = operation.format.upper()
+        suffix = _FORMAT_SUFFIXES.get(format, f".{format.lower()}")
+    else:
+        suffix = source.suffix
+    operation_hash = sha256(operation.key.encode()).hexdigest()[:16]
+    filename = f"{digest[:2]}/{digest}.{operation_hash}{suffix}"
+
+    temp_path = path / f".convert-{uuid.uuid4().hex}{suffix}"
+    try:
+        _get_process_pool().submit(
+            imageproc.convert,
+            str(source),
+            str(temp_path),
+            operation.format,
+            operation.max_size,
+            operation.quality,
+            operation.optimize,
+        ).result()
+        (path / filename).parent.mkdir(exist_ok=True)
+        temp_path.replace(path / filename)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+    store.write(
+        store.ImageVariant.replace(
+            digest=digest,
+            operation=operation.key,
+            filename=filename,
+            size=(path / filename).stat().st_size,
+        ).execute
+    )
+    return (path / filename).absolute()
+
+
+def convert_sync(source: Path, operation: ImageOperation) -> Path:
+    """Convert the image at source with operation in the process pool, blocking.
+
+    Converted images are stored next to downloaded ones and cached by the digest of
+    the source and the operation, so each conversion is only done once. Concurrent
+    calls for the same conversion share it.
+    """
+    source = Path(source)
+    digest = _source_digest(source)
+    key = (digest, operation.key)
+
+    variant = store.ImageVariant.get_or_none(
+        store.ImageVariant.digest == digest,
+        store.ImageVariant.operation == operation.key,
+    )
+    if variant is not None and (path / variant.filename).exists():
+        return (path / variant.filename).absolute()
+
+    with _conversions_lock:
+        future = _conversions.get(key)
+        converting = future is None
+        if converting:
+            future = _conversions[key] = concurrent.futures.Future()
+    if not converting:
+        return future.result()
+
+    try:
+        result = _convert(source, digest, operation)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _conversions_lock:
+            _conversions.pop(key, None)
+
+
+async def convert(source: Path, operation: ImageOperation) -> Path:
+    """Like convert_sync, without blocking the running loop."""
+    return await asyncio.to_thread(convert_sync, source, operation)
+
+
+def to_png(path: Path) -> Path:
+    """A PNG copy of the image at path, cached as its variant."""
+    return convert_sync(path, ImageOperation(format="PNG", optimize=True))
 
 
-async def download_withcache(url) -> tuple[str, bool]:
-    global path
+def webp2png(path: Path) -> Path:
+    """Convert the image at path to PNG in place, and return path. to_png leaves
+    the image as it is."""
+    temp_path = path.with_name(f".convert-{uuid.uuid4().hex}{path.suffix}")
+    try:
+        shutil.copyfile(to_png(path), temp_path)
+        temp_path.replace(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    if (filename := _stored_filename(path)) is not None:
+        # A stored image takes the size of its PNG now
+        store.write(
+            store.ImageFile.update(size=path.stat().st_size)
+            .where(store.ImageFile.filename == filename)
+            .execute
+        )
+    return path
+
+
+# Downloads in progress by URL, shared by concurrent requests for the same URL
+_downloads: dict[str, concurrent.futures.Future] = {}
+_downloads_lock = threading.Lock()
+
+
+def _guess_suffix(url: str, content_type: str | None) -> str:
+    suffix = Path(urlparse(url).path).suffix
+    if re.fullmatch(r"\.[A-Za-z0-9]{1,5}", suffix):
+        return suffix.lower()
+    if content_type:
+        return mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    return ""
+
+
+async def _download(
+    url: str, cached: store.ImageURL | None, cached_file: store.ImageFile | None
+) -> tuple[Path, bool]:
+    headers = {}
+    if cached_file is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    temp_path = path / f".download-{uuid.uuid4().hex}"
+    hash_ = sha256()
+    size = 0
+    try:
+        async with network.client(use_proxies=False).stream(
+            "GET", url, headers=headers
+        ) as response:
+            if response.status_code == 304 and cached_file is not None:
+                cached.fetched_ts = time.time()
+                await store.write_async(cached.save)
+                return (path / cached_file.filename).absolute(), False
+            if response.status_code != 200:
+                raise Exception(f"Download failed: {response.status_code}")
+
+            with temp_path.open("wb") as f:
+                async for chunk in response.aiter_bytes(const.IMAGE_DOWNLOAD_CHUNKSIZE):
+                    hash_.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+        digest = hash_.hexdigest()
+        image_file = store.ImageFile.get_or_none(store.ImageFile.digest == digest)
+        if image_file is not None and (path / image_file.filename).exists():
+            filename = image_file.filename
+        else:
+            suffix = _guess_suffix(url, response.headers.get("content-type"))
+            filename = f"{digest[:2]}/{digest}{suffix}"
+            (path / filename).parent.mkdir(exist_ok=True)
+            temp_path.replace(path / filename)
+            await store.write_async(
+                store.ImageFile.replace(
+                    digest=digest,
+                    filename=filename,
+                    size=size,
+                    created_ts=time.time(),
+                    accessed_ts=time.time(),
+                ).execute
+            )
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+    await store.write_async(
+        store.ImageURL.replace(
+            url=url,
+            digest=digest,
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+            fetched_ts=time.time(),
+        ).execute
+    )
+    return (path / filename).absolute(), True
+
+
+async def download_withcache(url) -> tuple[Path, bool]:
+    """Download the image at url into the content-addressed image store.
+
+    Images are stored once per content, by its sha256 digest. A URL already
+    downloaded is served from the store, and revalidated with the server once its
+    copy is older than IMAGE_REVALIDATE_INTERVAL. Concurrent calls for the same url
+    share one download.
+
+    Returns:
+        tuple[Path, bool]: Path of the image, and whether it was downloaded.
+    """
     if not util.is_valid_url(url):
         raise Exception("Pic url not valid")
-    prased_url = urlparse(url)
-    filename: str = prased_url.path.split("/")[-1]
 
-    _path = path / filename
-    if not _path.exists():
-        await util.download_async(url, _path)
-        return _path.absolute(), True
-    else:
-        return _path.absolute(), False
+    cached = store.ImageURL.get_or_none(store.ImageURL.url == url)
+    cached_file = None
+    if cached is not None:
+        cached_file = store.ImageFile.get_or_none(
+            store.ImageFile.digest == cached.digest
+        )
+        if cached_file is not None and not (path / cached_file.filename).exists():
+            cached_file = None
+    if cached_file is not None and (
+        time.time() - cached.fetched_ts < const.IMAGE_REVALIDATE_INTERVAL
+    ):
+        touch(cached_file.filename)
+        return (path / cached_file.filename).absolute(), False
+
+    with _downloads_lock:
+        future = _downloads.get(url)
+        downloading = future is None
+        if downloading:
+            future = _downloads[url] = concurrent.futures.Future()
+    if not downloading:
+        return await asyncio.wrap_future(future)
+
+    try:
+        result = await _download(url, cached, cached_file)
+        touch(result[0].relative_to(path.absolute()).as_posix())
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _downloads_lock:
+            _downloads.pop(url, None)
+
+
+# Last access time by filename, written to ImageFile in batches by flush_accesses
+_accesses: dict[str, float] = {}
+_accesses_lock = threading.Lock()
+
+
+def touch(filename: str):
+    """Record an access to the image stored as filename, relative to data/pic."""
+    with _accesses_lock:
+        _accesses[filename] = time.time()
+
+
+def flush_accesses():
+    global _accesses
+    with _accesses_lock:
+        accesses, _accesses = _accesses, {}
+    if not accesses:
+        return
+
+    def update():
+        for filename, ts in accesses.items():
+            store.ImageFile.update(accessed_ts=ts).where(
+                store.ImageFile.filename == filename
+            ).execute()
+
+    store.write(update)
+
+
+def _delete_image_rows(image_file: store.ImageFile, filenames: list[str]):
+    store.ImageVariant.delete().where(
+        store.ImageVariant.digest == image_file.digest
+    ).execute()
+    store.ImageURL.delete().where(store.ImageURL.digest == image_file.digest).execute()
+    store.ImageStorage.delete().where(
+        store.ImageStorage.filename.in_(filenames)
+    ).execute()
+    image_file.delete_instance()
+
+
+def _evict(image_file: store.ImageFile):
+    variants = list(
+        store.ImageVariant.select().where(
+            store.ImageVariant.digest == image_file.digest
+        )
+    )
+    filenames = [image_file.filename] + [variant.filename for variant in variants]
+    for filename in filenames:
+        (path / filename).unlink(missing_ok=True)
+    store.write(_delete_image_rows, image_file, filenames)
+
+
+def clean(max_bytes: int = 0, max_age: float = 0) -> tuple[int, int]:
+    """Evict stored images, least recently used first, until they take at most
+    max_bytes together, as well as all images unused for max_age seconds. 0 disables
+    the respective limit. Images used in the last IMAGE_EVICTION_GRACE seconds are
+    kept, as they may still be on their way to a pusher.
+
+    ImageStorage rows left without an image, and abandoned downloads, are removed too.
+
+    Returns:
+        tuple[int, int]: Number of images evicted and bytes freed, including their
+        variants.
+    """
+    flush_accesses()
+    now = time.time()
+    protected_since = now - const.IMAGE_EVICTION_GRACE
+
+    # Variants converted from an image count towards the budget and go with it
+    variant_sizes = dict(
+        store.ImageVariant.select(
+            store.ImageVariant.digest, fn.SUM(store.ImageVariant.size)
+        )
+        .group_by(store.ImageVariant.digest)
+        .tuples()
+    )
+    total = store.ImageFile.select(fn.SUM(store.ImageFile.size)).scalar() or 0
+    total += sum(variant_sizes.values())
+    evicted = []
+    freed = 0
+    query = (
+        store.ImageFile.select()
+        .where(store.ImageFile.accessed_ts < protected_since)
+        .order_by(store.ImageFile.accessed_ts)
+    )
+    for image_file in query.iterator():
+        expired = max_age and image_file.accessed_ts < now - max_age
+        if not expired and not (max_bytes and total > max_bytes):
+            break
+        evicted.append(image_file)
+        size = image_file.size + variant_sizes.get(image_file.digest, 0)
+        total -= size
+        freed += size
+    for image_file in evicted:
+        _evict(image_file)
+
+    orphans = [
+        storage.id
+        for storage in store.ImageStorage.select().where(
+            store.ImageStorage.filename.not_in(
+                store.ImageFile.select(store.ImageFile.filename)
+            )
+        )
+        if not (path / storage.filename).exists()
+    ]
+    for i in range(0, len(orphans), store.SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = orphans[i : i + store.SQLITE_MAX_VARIABLE_NUMBER]
+        store.write(
+            store.ImageStorage.delete().where(store.ImageStorage.id.in_(chunk)).execute
+        )
+
+    for pattern in (".download-*", ".convert-*"):
+        for temp_path in path.glob(pattern):
+            if temp_path.stat().st_mtime < protected_since:
+                temp_path.unlink(missing_ok=True)
+
+    if evicted or orphans:
+        log.info(
+            f"Image cache: evicted {len(evicted)} images ({freed} bytes), "
+            f"removed {len(orphans)} orphaned image links"
+        )
+    return len(evicted), freed
+
+
+def register_untracked() -> int:
+    """Register images downloaded before the content-addressed store in ImageFile, so
+    they are evicted like the others, with their mtime as last access. They're the
+    files directly in data/pic. Copies of stored images are removed instead, and
+    links to them lead to the stored image.
+
+    Returns:
+        int: Number of images registered.
+    """
+    files = [
+        file
+        for file in path.iterdir()
+        if file.is_file() and not file.name.startswith(".")
+    ]
+    tracked = set()
+    for i in range(0, len(files), store.SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = [file.name for file in files[i : i + store.SQLITE_MAX_VARIABLE_NUMBER]]
+        tracked.update(
+            store.ImageFile.select(store.ImageFile.filename)
+            .where(store.ImageFile.filename.in_(chunk))
+            .scalars()
+        )
+
+    registered = 0
+    for file in files:
+        if file.name in tracked:
+            continue
+        digest = _file_digest(file)
+        stored = store.ImageFile.get_or_none(store.ImageFile.digest == digest)
+        if stored is not None and (path / stored.filename).exists():
+            store.write(
+                store.ImageStorage.update(filename=stored.filename)
+                .where(store.ImageStorage.filename == file.name)
+                .execute
+            )
+            file.unlink()
+            continue
+        stat = file.stat()
+        store.write(
+            store.ImageFile.replace(
+                digest=digest,
+                filename=file.name,
+                size=stat.st_size,
+                created_ts=stat.st_mtime,
+                accessed_ts=stat.st_mtime,
+            ).execute
+        )
+        registered += 1
+    if registered:
+        log.info(f"Image cache: registered {registered} previously downloaded images")
+    return registered
+
+
+_cache_manager: asyncio.Task | None = None
+
+
+async def _run_cache_manager():
+    try:
+        await asyncio.to_thread(register_untracked)
+    except Exception as e:
+        log.warning(f"Registering downloaded images failed: {e}", exc_info=True)
+    while True:
+        image_config = config.main().image
+        try:
+            await asyncio.to_thread(
+                clean,
+                image_config.max_size_mb * 1024 * 1024,
+                image_config.max_ageday * 24 * 3600,
+            )
+        except Exception as e:
+            log.warning(f"Image cache cleaning failed: {e}", exc_info=True)
+        await asyncio.sleep(image_config.clean_interval)
+
+
+def start_cache_manager():
+    """Start evicting images in the background on the running loop."""
+    global _cache_manager
+    _cache_manager = asyncio.create_task(_run_cache_manager())
+
+
+def stop_cache_manager():
+    if _cache_manager is not None:
+        _cache_manager.cancel()
+    flush_accesses()
 
 
 def get_public_url(img: StructImage, messagesyncer_base_url: str) -> str:
     if img.islocal:
         id_ = ""
-        path = Path(img.source)
-        filename = path.name
+        img_path = Path(img.source)
+        try:
+            filename = img_path.absolute().relative_to(path.absolute()).as_posix()
+        except ValueError:
+            filename = img_path.name
 
         if query_res := store.ImageStorage.get_or_none(
             store.ImageStorage.filename == filename
@@ -91,8 +609,8 @@ def get_public_url(img: StructImage, messagesyncer_base_url: str) -> str:
                 random.choices(string.ascii_letters + string.digits, k=8)
             )
             id_ = sha256(hash_src.encode()).hexdigest().lower()[0:32]
-            mime = util.get_image_mime_suffix(str(path.absolute()))
-            store.ImageStorage.create(filename=filename, id=id_, mime=mime)
+            mime = util.get_image_mime_suffix(str(img_path.absolute()))
+            store.write(store.ImageStorage.create, filename=filename, id=id_, mime=mime)
         return f"{messagesyncer_base_url}/res/img/{id_}"
     else:
         return img.source
@@ -0,0 +1,48 @@
+"""Image conversions run in the worker processes of image's process pool.
+
+This module must stay free of MessageSyncer imports, so that worker processes
+start quickly and don't touch the database or config.
+"""
+
+from PIL import Image, ImageSequence
+
+# Formats which can be saved with save_all as an animation
+ANIMATED_FORMATS = {"PNG", "WEBP", "GIF"}
+
+
+def convert(
+    source: str,
+    target: str,
+    format: str = None,
+    max_size: tuple[int, int] = None,
+    quality: int = None,
+    optimize: bool = False,
+):
+    """Save the image at source to target, converted to format, scaled down to fit
+    in max_size, and encoded with quality. Animations are kept if format supports them.
+    """
+    with Image.open(source) as img:
+        format = (format or img.format).upper()
+        if getattr(img, "is_animated", False) and format in ANIMATED_FORMATS:
+            frames = [frame.copy() for frame in ImageSequence.Iterator(img)]
+        else:
+            frames = [img.copy()]
+        info = img.info
+
+    for frame in frames:
+        if max_size:
+            frame.thumbnail(max_size)
+    if format == "JPEG":
+        frames = [frame.convert("RGB") for frame in frames]
+
+    options = {}
+    if quality is not None:
+        options["quality"] = quality
+    if optimize:
+        options["optimize"] = True
+    if len(frames) > 1:
+        options["save_all"] = True
+        options["append_images"] = frames[1:]
+        options["duration"] = [frame.info.get("duration", 100) for frame in frames]
+        options["loop"] = info.get("loop", 0)
+    frames[0].save(target, format, **options)
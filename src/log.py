@@ -1,7 +1,16 @@
+import atexit
+import copy
+import itertools
+import json
 import logging
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
 from logging import *
-from logging import root
+from logging import handlers, root
 from pathlib import Path
 
 import colorlog
@@ -11,39 +20,194 @@ import const
 path = Path() / "data" / "log"
 path.mkdir(parents=True, exist_ok=True)
 
-log_list: list[str] = []
+
+@dataclass(slots=True)
+class LogEntry:
+    seq: int
+    time: float
+    level: str
+    levelno: int
+    name: str
+    message: str
+
+    def __str__(self) -> str:
+        asctime = datetime.fromtimestamp(self.time).strftime("%Y-%m-%d %H:%M:%S")
+        msecs = int(self.time * 1000) % 1000
+        return f"{asctime},{msecs:03d}[{self.level}][{self.name}] {self.message}"
+
+
+class LogBuffer:
+    """The latest log records, in a thread-safe ring buffer.
+
+    Each record gets a sequence number, increasing by one per record, so clients
+    can page through the buffer and poll for new records.
+    """
+
+    def __init__(self, maxlength: int) -> None:
+        self._entries: deque[LogEntry] = deque(maxlen=maxlength)
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+
+    def append(self, record: logging.LogRecord, message: str):
+        with self._lock:
+            self._entries.append(
+                LogEntry(
+                    next(self._seq),
+                    record.created,
+                    record.levelname,
+                    record.levelno,
+                    record.name,
+                    message,
+                )
+            )
+
+    def query(
+        self,
+        level: int = None,
+        name: str = None,
+        since: float = None,
+        until: float = None,
+        before: int = None,
+        after: int = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> list[LogEntry]:
+        """Return up to limit entries of at least level, from the logger name or its
+        children, with since <= time < until and after < seq < before.
+
+        Entries are newest first, or oldest first if after is given, skipping offset.
+        """
+
+        def matches(entry: LogEntry) -> bool:
+            return (
+                (level is None or entry.levelno >= level)
+                and (
+                    name is None
+                    or entry.name == name
+                    or entry.name.startswith(name + ".")
+                )
+                and (since is None or entry.time >= since)
+                and (until is None or entry.time < until)
+            )
+
+        result = []
+        with self._lock:
+            entries = self._entries
+            if after is not None:
+                # Sequence numbers are consecutive, so the position of after is known
+                first = entries[0].seq if entries else 0
+                start = max(0, min(after + 1 - first, len(entries)))
+                entries = itertools.islice(entries, start, None)
+            else:
+                entries = reversed(entries)
+            for entry in entries:
+                if before is not None and entry.seq >= before:
+                    if after is None:
+                        continue
+                    break
+                if not matches(entry):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                result.append(entry)
+                if len(result) >= limit:
+                    break
+        return result
+
+
+records = LogBuffer(const.LOGLIST_MAXLENGTH)
 
 
 class ListHandler(logging.Handler):
-    def __init__(self):
-        super().__init__()
-        self.maxlength = const.LOGLIST_MAXLENGTH
+    """Keeps records in records."""
 
     def emit(self, record):
-        log_entry = self.format(record)
-        if len(log_list) > self.maxlength:
-            log_list.pop(0)
-        log_list.append(log_entry)
+        try:
+            records.append(record, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+# Attributes every LogRecord has; the others were passed as extra
+_record_attributes = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one line of JSON, including the fields passed as extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _record_attributes:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RotatingFileHandler(handlers.RotatingFileHandler):
+    """Rotates by size, and also every interval seconds if interval is set."""
+
+    def __init__(self, filename, max_bytes: int, backup_count: int, interval: float):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+def _remove_old_logs(log_name: str, keep: int):
+    # Files of versions which started a new file on every start
+    old = sorted(path.glob(f"{log_name}-*.log"), key=lambda p: p.stat().st_mtime)
+    for file in old[: max(0, len(old) - keep)]:
+        file.unlink(missing_ok=True)
 
 
 def get_logging_handlers(log_name):
     import config
 
+    logging_config = config.main().logging
     list_level = file_level = console_level = (
-        logging.DEBUG if config.main().logging.verbose else logging.INFO
+        logging.DEBUG if logging_config.verbose else logging.INFO
     )
-    log_file = path / f'{log_name}-{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.log'
     formatstr = "%(asctime)s[%(levelname)s][%(name)s] %(message)s"
 
-    log_file.touch(exist_ok=True)
-
-    file_handler = logging.FileHandler(str(log_file), encoding="utf-8")
+    _remove_old_logs(log_name, logging_config.file_backup_count)
+    if logging_config.file_format == "jsonl":
+        log_file, formatter = path / f"{log_name}.jsonl", JSONFormatter()
+    else:
+        log_file, formatter = path / f"{log_name}.log", logging.Formatter(formatstr)
+    file_handler = RotatingFileHandler(
+        str(log_file),
+        max_bytes=logging_config.file_max_mb * 1024 * 1024,
+        backup_count=logging_config.file_backup_count,
+        interval=logging_config.file_rotate_hours * 3600,
+    )
     file_handler.setLevel(file_level)
-    file_handler.setFormatter(logging.Formatter(formatstr))
+    file_handler.setFormatter(formatter)
 
     list_handler = ListHandler()
     list_handler.setLevel(list_level)
-    list_handler.setFormatter(logging.Formatter(formatstr))
+    list_handler.setFormatter(logging.Formatter("%(message)s"))
 
     console_handler = colorlog.StreamHandler()
     console_handler.setLevel(console_level)
@@ -63,9 +227,46 @@ def get_logging_handlers(log_name):
     return [file_handler, console_handler, list_handler]
 
 
+class QueueHandler(handlers.QueueHandler):
+    """Puts records on the queue with their message merged, but otherwise unformatted,
+    so the listener's handlers format them, tracebacks included, each their own way."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+listener: handlers.QueueListener | None = None
+
+
+def stop_listener():
+    """Handle the records queued so far, and close the handlers."""
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(stop_listener)
+
+
 def init():
+    global listener
     # [logging.getLogger(name).setLevel(logging.INFO) for name in ('peewee', 'asyncio', 'tzlocal', 'PIL.Image')]
-    logging.basicConfig(level=logging.DEBUG, handlers=get_logging_handlers("root"))
+    stop_listener()
+    handlers_ = get_logging_handlers("root")
+    # Handlers do their I/O on the listener's thread, never on the logging thread
+    log_queue = queue.SimpleQueue()
+    listener = handlers.QueueListener(log_queue, *handlers_, respect_handler_level=True)
+    listener.start()
+    # Records below every handler's level are dropped before they're even created
+    logging.basicConfig(
+        level=min(handler.level for handler in handlers_),
+        handlers=[QueueHandler(log_queue)],
+        force=True,
+    )
 
 
 init()
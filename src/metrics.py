@@ -0,0 +1,201 @@
+"""In-process metrics, exposed at /metrics in the Prometheus text format.
+
+Recording a value takes a lock and a dict lookup, so instrumentation can stay on.
+"""
+
+import asyncio
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type_ = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def samples(self) -> list[tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of each sample."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [("", _format_labels(self.labelnames, k), v) for k, v in values]
+
+
+class Gauge(Metric):
+    """A value set directly, or read from function when collected. function
+    returns the value, or a dict of values by label values."""
+
+    type_ = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function: Callable = None):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._function = function
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self._function is not None:
+            values = self._function()
+            values = values.items() if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [
+            (
+                "",
+                _format_labels(self.labelnames, k if isinstance(k, tuple) else (k,)),
+                v,
+            )
+            for k, v in values
+        ]
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: [count per bucket..., count above the last one, sum]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            if (counts := self._values.get(labels)) is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labels) -> "_Timer":
+        """Observe the duration of a with block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        samples = []
+        for labels, counts in values:
+            cumulative = 0
+            bounds = [*self.buckets, float("inf")]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                samples.append(
+                    ("_bucket", _format_labels(self.labelnames, labels, le), cumulative)
+                )
+            formatted = _format_labels(self.labelnames, labels)
+            samples.append(("_count", formatted, cumulative))
+            samples.append(("_sum", formatted, counts[-1]))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+registry: dict[str, Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(type_: type, name: str, *args, **kwargs):
+    with _registry_lock:
+        if (metric := registry.get(name)) is None:
+            metric = registry[name] = type_(name, *args, **kwargs)
+        return metric
+
+
+def counter(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    return _register(Counter, name, help, labelnames)
+
+
+def gauge(
+    name: str, help: str, labelnames: tuple[str, ...] = (), function: Callable = None
+) -> Gauge:
+    return _register(Gauge, name, help, labelnames, function)
+
+
+def histogram(
+    name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS
+) -> Histogram:
+    return _register(Histogram, name, help, labelnames, buckets)
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+event_loop_lag = histogram(
+    "messagesyncer_event_loop_lag_seconds",
+    "How late the main event loop woke up from a sleep",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Measure the lag of the running loop until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - start - interval))
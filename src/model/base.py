@@ -67,6 +67,13 @@ class Adapter(ABC, Generic[TADAPTERCONFIG, TADAPTERINSTANCECONFIG]):
 
         self.logger = log.getLogger(self.name)
 
+    async def start(self) -> None:
+        """Called once before the adapter is first used. Override to set up long-lived
+        resources, such as HTTP sessions or auth tokens."""
+
+    async def close(self) -> None:
+        """Called when the adapter is discarded. Override to release what start() set up."""
+
     @property
     def config(self) -> TADAPTERCONFIG:
         return self.config_manager.value
@@ -17,6 +17,12 @@ class GetterConfig(AdapterConfig):
     trigger: list[str] = field(
         default_factory=list
     )  # Partially supports hotreload. Takes effect after every time refreshes.
+    detail_concurrency: Union[int, None] = field(
+        default=None
+    )  # Overrides policy.detail_concurrency for this getter
+    # Refresh on an event loop of its own, for getters making blocking calls.
+    # Getters calling requests are detected and moved there on their first refresh.
+    dedicated_loop: bool = field(default=False)
 
 
 @dataclass
@@ -38,6 +44,8 @@ class Getter(
         self._first = True
         self._triggers: dict[str, aiocron.Cron] = {}
         self._consecutive_failures_number: int = 0
+        # Ids of the latest list which are known to be stored
+        self._seen_ids: set[str] = set()
 
     @property
     def available(self):
@@ -1,12 +1,29 @@
+import copy
+import itertools
+import json
 from abc import ABC, abstractmethod
 from dataclasses import asdict, dataclass
 from datetime import datetime
+from hashlib import sha256
+from typing import Callable
 
 import util
 
+# Changes of elements after their creation, by which Structs notice that an element
+# of theirs changed in place since they cached a rendering
+_element_changes = itertools.count(1)
+_element_change = 0
 
-@dataclass
+
+@dataclass(slots=True)
 class StructElement(ABC):
+    def __setattr__(self, name: str, value) -> None:
+        global _element_change
+        # Unless set for the first time, by __init__
+        if hasattr(self, name):
+            _element_change = next(_element_changes)
+        object.__setattr__(self, name, value)
+
     def __str__(self) -> str:
         return ""
 
@@ -14,7 +31,7 @@ class StructElement(ABC):
     def asmarkdown(self) -> str: ...
 
 
-@dataclass
+@dataclass(slots=True)
 class StructText(StructElement):
     text: str
     bold: bool = False
@@ -32,7 +49,7 @@ class StructText(StructElement):
         return self.text.replace("\n", "  \n")
 
 
-@dataclass
+@dataclass(slots=True)
 class StructTitle(StructText):
     heading: int = 0
 
@@ -40,11 +57,11 @@ class StructTitle(StructText):
         return self.text + "\n"
 
     def asmarkdown(self) -> str:
-        finalstr = super().asmarkdown()
+        finalstr = StructText.asmarkdown(self)
         return "#" * self.heading + " " + finalstr + "  \n"
 
 
-@dataclass
+@dataclass(slots=True)
 class StructImage(StructElement):
     source: str
     alt: str = ""
@@ -62,7 +79,7 @@ class StructImage(StructElement):
         return util.is_local_or_url(self.source) == "local"
 
 
-@dataclass
+@dataclass(slots=True)
 class StructURL(StructElement):
     source: str
     title: StructText
@@ -80,11 +97,21 @@ types = {
     "image": StructImage,
     "url": StructURL,
 }
+_type_names = {v: k for k, v in types.items()}
 
 
 class Struct:
+    """A message, made of StructElements.
+
+    Renderings (str, asmarkdown, asdict) and the digest are cached until content
+    changes, i.e. its list or one of its elements.
+    """
+
     def __init__(self, dict_: dict = None) -> None:
-        self.content: list[StructElement] = []
+        self._content: list[StructElement] = []
+        self._loader: Callable[[], list[StructElement]] | None = None
+        self._snapshot: tuple[tuple[StructElement, ...], int] = ((), 0)
+        self._cache: dict[str, object] = {}
 
         if dict_:
             for element in dict_:
@@ -93,6 +120,36 @@ class Struct:
                 data_ = element["data"]
                 self.content.append(type_(**data_))
 
+    @classmethod
+    def lazy(cls, loader: Callable[[], list[StructElement]]) -> "Struct":
+        """A Struct whose content is only created by loader when it's first used."""
+        struct = cls()
+        struct._loader = loader
+        return struct
+
+    @property
+    def content(self) -> list[StructElement]:
+        if self._loader is not None:
+            self._content = self._loader()
+            self._loader = None
+        return self._content
+
+    @content.setter
+    def content(self, content: list[StructElement]):
+        self._content = content
+        self._loader = None
+        self._cache = {}
+
+    def _cached(self, name: str, render: Callable[[], object]):
+        content = (tuple(self.content), _element_change)
+        # Compares elements by identity first, so this is cheap when nothing changed
+        if content != self._snapshot:
+            self._snapshot = content
+            self._cache = {}
+        if name not in self._cache:
+            self._cache[name] = render()
+        return self._cache[name]
+
     def image(self, source: str | list[str] = None) -> "Struct":
         return self._create(source, StructImage)
 
@@ -104,29 +161,56 @@ class Struct:
             self.content.append(type_(source))
         elif isinstance(source, list):
             self.content.extend([type_(_source) for _source in source])
+        self._cache = {}
         return self
 
     def extend(self, another: "Struct") -> "Struct":
         for content in another.content:
             self.content.append(content)
+        self._cache = {}
         return self
 
     def asdict(self):
-        result = []
-        for element in self.content:
-            result.append(
+        """The content as plain data."""
+        return copy.deepcopy(self._asdict())
+
+    def _asdict(self):
+        return self._cached(
+            "asdict",
+            lambda: [
                 {
-                    "type": [k for k, v in types.items() if v == type(element)][0],
+                    "type": _type_names[type(element)],
                     "data": asdict(element),
                 }
-            )
-        return result
+                for element in self.content
+            ],
+        )
 
     def __str__(self) -> str:
-        return "".join([str(element) for element in self.content])
+        return self._cached(
+            "str", lambda: "".join([str(element) for element in self.content])
+        )
 
     def asmarkdown(self) -> str:
-        return "".join([element.asmarkdown() for element in self.content])
+        return self._cached(
+            "markdown",
+            lambda: "".join([element.asmarkdown() for element in self.content]),
+        )
+
+    @property
+    def digest(self) -> str:
+        """sha256 of the content, the same in every process."""
+        return self._cached(
+            "digest",
+            lambda: sha256(
+                json.dumps(self._asdict(), ensure_ascii=False, sort_keys=True).encode()
+            ).hexdigest(),
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Struct):
+            return NotImplemented
+        return self.content == other.content
 
     def as_preview_str(self):
         selfstripped = str(self).replace("\n", "\\n")
@@ -1,46 +1,415 @@
+import asyncio
+import itertools
+import random
 import time
-from datetime import datetime
+import weakref
 from unittest.mock import patch
+from urllib.parse import urlsplit
 
+import httpx
 import requests
 
+try:
+    import h2
+except ImportError:
+    h2 = None
+
 import config
 import const
+import engine
 import log
+import metrics
+import tracing
 import util
 
 
 def _process_proxy(dict_: dict):
-    dict_.setdefault("proxies", config.main().network.proxies)
+    # A copy, as requests adds the proxies of the environment to the dict it gets,
+    # and the config is shared by all threads
+    dict_.setdefault("proxies", dict(config.main().network.proxies))
     return dict_
 
 
 original_request_method = requests.Session.request
 
+# Ids of outgoing requests, to tell their log lines apart
+_request_ids = itertools.count(1)
+
+_request_duration = metrics.histogram(
+    "messagesyncer_http_request_duration_seconds",
+    "Duration of outgoing HTTP requests, each retry counted separately",
+    ("client", "method", "host", "status"),
+)
+
+
+def _request_labels(args: tuple, kwargs: dict) -> tuple[str, str]:
+    """method and host of a requests.Session.request(self, method, url) call."""
+    method = kwargs.get("method", args[1] if len(args) > 1 else "")
+    url = kwargs.get("url", args[2] if len(args) > 2 else "")
+    return str(method).upper(), urlsplit(str(url)).hostname or ""
+
+
+class _LazyCallStr:
+    """A function call, formatted only when a log line actually contains it."""
+
+    def __init__(self, function: str, args: tuple, kwargs: dict) -> None:
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        max_length = const.LOG_ARGUMENT_MAXLENGTH
+        args_str = [util.truncated_repr(arg, max_length) for arg in self.args]
+        args_str += [
+            f"{key}={util.truncated_repr(value, max_length)}"
+            for key, value in self.kwargs.items()
+        ]
+        return f"{self.function}({', '.join(args_str)})"
+
+
+def retry_backoff(attempt: int) -> float:
+    """Seconds to wait before retrying after the attempt-th failed attempt."""
+    return const.HTTP_RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+# Names of the getters which called requests in a refresh on a loop shared with
+# others. core refreshes them on loops of their own.
+blocking_callers: set[str] = set()
+
+
+def _on_shared_loop() -> bool:
+    """Whether blocking now would stall coroutines of other callers."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    worker = engine.current_worker()
+    return worker is None or worker.shared
+
 
 def requests_proxy(*args, **kwargs):
     kwargs = _process_proxy(kwargs)
     logger = log.getLogger("requests_proxy")
-    total_str = util.generate_function_call_str(
-        "requests.Session.request", *args, **kwargs
+    on_shared_loop = _on_shared_loop()
+    trace_ = tracing.current.get()
+    if (
+        on_shared_loop
+        and trace_ is not None
+        and trace_.kind == tracing.REFRESH
+        and trace_.name not in blocking_callers
+    ):
+        blocking_callers.add(trace_.name)
+        logger.warning(
+            f"{trace_.name} blocks a shared event loop by calling requests. "
+            "It runs on an event loop of its own from its next refresh on"
+        )
+    request_id = next(_request_ids)
+    logger.debug(
+        "%s: start: %s",
+        request_id,
+        _LazyCallStr("requests.Session.request", args, kwargs),
     )
-    request_str = hash(total_str)
+    method, host = _request_labels(args, kwargs)
     max_retry_time = const.PROXY_REQUEST_MAXRETRYTIME
     for i in range(max_retry_time):
-        logger.debug(f"{request_str}: start: {total_str}")
+        retrystr = f"({i+1}/{max_retry_time})"
+        start_time = time.perf_counter()
         try:
-            retrystr = f"({i+1}/{max_retry_time})"
-            logger.debug(f"{request_str}: try{retrystr}")
-            start_time = time.time()
             result = original_request_method(*args, **kwargs)
-            end_time = time.time()
-            logger.debug(f"{request_str}: finished after {end_time-start_time} seconds")
-            return result
         except Exception as e:
-            logger.warning(f"{request_str}: failed{retrystr}: {e}")
-            if i + 1 >= max_retry_time:
+            _request_duration.observe(
+                time.perf_counter() - start_time, "requests", method, host, "error"
+            )
+            # Waiting to retry on a shared loop would stall every coroutine on it,
+            # so the caller fails, and is retried on its own terms instead
+            if i + 1 >= max_retry_time or on_shared_loop:
+                logger.warning(f"{request_id}: failed{retrystr}: {e}")
                 raise e
+            delay = retry_backoff(i + 1)
+            logger.warning(
+                f"{request_id}: failed{retrystr}: {e}. Retry in {delay:.2f}s"
+            )
+            time.sleep(delay)
+            continue
+
+        total = time.perf_counter() - start_time
+        _request_duration.observe(
+            total, "requests", method, host, str(result.status_code)
+        )
+        logger.debug(
+            "%s: finished%s: %s after %.3fs (%.3fs until response headers)",
+            request_id,
+            retrystr,
+            result.status_code,
+            total,
+            result.elapsed.total_seconds(),
+            extra={
+                "request_id": request_id,
+                "timing": {
+                    "total": total,
+                    "headers": result.elapsed.total_seconds(),
+                },
+            },
+        )
+        return result
 
 
 def force_proxies_patch():
     return patch("requests.Session.request", new=requests_proxy)
+
+
+_installed_patch = None
+
+
+def install_proxies_patch():
+    """Keep force_proxies_patch active for the rest of the process lifetime."""
+    global _installed_patch
+    if _installed_patch is None:
+        _installed_patch = force_proxies_patch()
+        _installed_patch.start()
+
+
+_IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"])
+# Stages of httpcore's trace events, as reported in timing
+_TRACE_STAGES = {
+    "connection.connect_tcp": "connect",
+    "connection.connect_unix_socket": "connect",
+    "connection.start_tls": "tls",
+    "http11.send_request_headers": "send",
+    "http2.send_request_headers": "send",
+    "http11.receive_response_headers": "headers",
+    "http2.receive_response_headers": "headers",
+}
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Logs requests with an id and timings, and retries failed ones with backoff.
+
+    Requests are retried if they couldn't connect, or failed otherwise and are
+    idempotent.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, retries: int) -> None:
+        self._transport = transport
+        self._retries = retries
+        self.logger = log.getLogger("network.client")
+
+    def _should_retry(self, request: httpx.Request, e: Exception) -> bool:
+        if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+            return True
+        return isinstance(e, httpx.TransportError) and (
+            request.method in _IDEMPOTENT_METHODS
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request_id = next(_request_ids)
+        self.logger.debug(
+            "%s: start: %s %s", request_id, request.method, _LazyRequestStr(request)
+        )
+
+        max_try = self._retries + 1
+        for i in range(max_try):
+            retrystr = f"({i+1}/{max_try})"
+            timing = {}
+            starts = {}
+
+            async def trace(event_name: str, info: dict):
+                name, _, phase = event_name.rpartition(".")
+                if (stage := _TRACE_STAGES.get(name)) is None:
+                    return
+                if phase == "started":
+                    starts[stage] = time.perf_counter()
+                elif stage in starts:
+                    timing[stage] = time.perf_counter() - starts.pop(stage)
+
+            request.extensions = {**request.extensions, "trace": trace}
+            start_time = time.perf_counter()
+            try:
+                response = await self._transport.handle_async_request(request)
+            except Exception as e:
+                _request_duration.observe(
+                    time.perf_counter() - start_time,
+                    "httpx",
+                    request.method,
+                    request.url.host,
+                    "error",
+                )
+                if i + 1 >= max_try or not self._should_retry(request, e):
+                    self.logger.warning(f"{request_id}: failed{retrystr}: {e!r}")
+                    raise
+                delay = retry_backoff(i + 1)
+                self.logger.warning(
+                    f"{request_id}: failed{retrystr}: {e!r}. Retry in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            timing["total"] = time.perf_counter() - start_time
+            _request_duration.observe(
+                timing["total"],
+                "httpx",
+                request.method,
+                request.url.host,
+                str(response.status_code),
+            )
+            self.logger.debug(
+                "%s: finished%s: %s after %s",
+                request_id,
+                retrystr,
+                response.status_code,
+                _LazyTimingStr(timing),
+                extra={"request_id": request_id, "timing": timing},
+            )
+            return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class _LazyRequestStr:
+    def __init__(self, request: httpx.Request) -> None:
+        self.request = request
+
+    def __str__(self) -> str:
+        text = str(self.request.url)
+        try:
+            if content := self.request.content:
+                text += " " + util.truncated_repr(content, const.LOG_ARGUMENT_MAXLENGTH)
+        except httpx.RequestNotRead:
+            text += " <stream>"
+        return text
+
+
+class _LazyTimingStr:
+    def __init__(self, timing: dict) -> None:
+        self.timing = timing
+
+    def __str__(self) -> str:
+        return ", ".join(f"{key} {value:.3f}s" for key, value in self.timing.items())
+
+
+class _HostLimitedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release) -> None:
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """Limits the number of concurrent requests to each host.
+    A request counts until its response is closed."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, per_host: int) -> None:
+        self._transport = transport
+        self._per_host = per_host
+        self._semaphores: dict[tuple, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = (request.url.scheme, request.url.host, request.url.port)
+        if (semaphore := self._semaphores.get(host)) is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self._per_host)
+        await semaphore.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_HostLimitedStream(response.stream, semaphore.release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _proxy_mount_pattern(key: str) -> str:
+    """Convert a key of requests' proxies to a httpx mount pattern."""
+    if "://" in key:
+        return key
+    if key == "all":
+        return "all://"
+    return f"{key}://"
+
+
+# Clients by event loop, as a client can only be used on the loop it's created on
+_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[bool, tuple[tuple, httpx.AsyncClient]]
+] = weakref.WeakKeyDictionary()
+
+
+def _create_client(options: tuple) -> httpx.AsyncClient:
+    proxies, timeout, retries, max_connections, per_host = options
+
+    def transport(proxy=None):
+        return InstrumentedTransport(
+            HostLimitedTransport(
+                httpx.AsyncHTTPTransport(
+                    proxy=proxy,
+                    http2=h2 is not None,
+                    limits=httpx.Limits(max_connections=max_connections),
+                ),
+                per_host,
+            ),
+            retries,
+        )
+
+    return httpx.AsyncClient(
+        transport=transport(),
+        mounts={_proxy_mount_pattern(key): transport(proxy) for key, proxy in proxies},
+        timeout=timeout,
+        follow_redirects=True,
+    )
+
+
+def client(use_proxies: bool = True) -> httpx.AsyncClient:
+    """Shared, pooled async HTTP client of the running event loop.
+
+    It applies network.proxies unless use_proxies is False, and the timeout,
+    retries and connection limits of the network config. Don't close it.
+    """
+    network_config = config.main().network
+    proxies = network_config.proxies if use_proxies else {}
+    options = (
+        tuple(sorted(proxies.items())),
+        network_config.timeout,
+        network_config.retries,
+        network_config.max_connections,
+        network_config.max_connections_per_host,
+    )
+
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, {})
+    cached = clients.get(use_proxies)
+    if cached is not None and cached[0] == options:
+        return cached[1]
+
+    new_client = _create_client(options)
+    clients[use_proxies] = (options, new_client)
+    if cached is not None:
+        # The network config changed. Give requests in flight some time to finish.
+        loop.call_later(
+            const.HTTP_CLIENT_CLOSE_DELAY,
+            lambda: asyncio.ensure_future(cached[1].aclose()),
+        )
+    return new_client
+
+
+async def close_clients():
+    """Close the clients of the running event loop."""
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for _, client_ in clients.values():
+        await client_.aclose()
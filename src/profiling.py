@@ -0,0 +1,217 @@
+"""Profiling of the running process, started and read through the API.
+
+One session runs at a time, for a number of seconds or for one refresh of a getter:
+
+- cprofile: pstats of the calls made on one thread: the main loop, or the worker
+  loop of the getter.
+- sample: call stacks of all threads, or of the getter's worker loop, sampled at an
+  interval and written as collapsed stacks, the input of flamegraph.pl and
+  speedscope.
+- tracemalloc: the code lines which allocated the most memory still held.
+
+Other work sharing the thread of a getter, like other getters on its worker loop,
+is profiled too.
+"""
+
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from abc import ABC, abstractmethod
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import const
+import core
+import log
+import task
+from model import Getter
+
+logger = log.getLogger("profiling")
+
+
+class Profiler(ABC):
+    @abstractmethod
+    def start(self): ...
+
+    @abstractmethod
+    def stop(self) -> str:
+        """Stop, and return the result as text."""
+
+
+class CProfiler(Profiler):
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self) -> str:
+        self.profile.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.limit)
+        return stream.getvalue()
+
+
+def _collapse(thread_name: str, frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_qualname} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler(Profiler):
+    def __init__(self, interval: float, thread_ids: set[int] = None) -> None:
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.samples: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profiling-sampler", daemon=True
+        )
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self.thread_ids is not None and thread_id not in self.thread_ids:
+                    continue
+                self.samples[
+                    _collapse(names.get(thread_id, str(thread_id)), frame)
+                ] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stopped.set()
+        self._thread.join()
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
+
+
+class AllocationProfiler(Profiler):
+    """Memory allocated during the session and still held at its end, by line."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(const.PROFILE_TRACEMALLOC_FRAMES)
+            self._started_tracing = True
+        self.before = tracemalloc.take_snapshot()
+
+    def stop(self) -> str:
+        after = tracemalloc.take_snapshot()
+        if self._started_tracing:
+            tracemalloc.stop()
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = after.filter_traces(filters).compare_to(
+            self.before.filter_traces(filters), "lineno"
+        )
+        return "".join(f"{stat}\n" for stat in stats[: self.limit])
+
+
+MODES = ["cprofile", "sample", "tracemalloc"]
+
+
+@dataclass
+class Session:
+    mode: str
+    seconds: float
+    getter: Optional[str] = None
+    start_ts: float = field(default_factory=time.time)
+    end_ts: Optional[float] = None
+    result: Optional[str] = None
+    error: Optional[str] = None
+
+    def __post_init__(self):
+        self._stop = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _call(self, function: Callable, getter: Getter = None):
+        """Call function on the thread of getter's worker loop, or here."""
+        if getter is None:
+            return function()
+
+        async def call():
+            return function()
+
+        return await core.refresh_loop(getter).run(call())
+
+    def _profiler(self, thread_id: int) -> Profiler:
+        if self.mode == "cprofile":
+            return CProfiler(const.PROFILE_RESULT_LIMIT)
+        if self.mode == "sample":
+            return SamplingProfiler(
+                const.PROFILE_SAMPLE_INTERVAL,
+                {thread_id} if self.getter is not None else None,
+            )
+        return AllocationProfiler(const.PROFILE_RESULT_LIMIT)
+
+    async def _run(self, getter: Getter = None):
+        try:
+            thread_id = await self._call(threading.get_ident, getter)
+            profiler = self._profiler(thread_id)
+            await self._call(profiler.start, getter)
+            logger.info(f"{self.mode} session started")
+            try:
+                waits = [asyncio.create_task(self._stop.wait())]
+                if getter is not None:
+                    waits.append(task.tasks[task.create_task(core.refresh(getter))])
+                await asyncio.wait(
+                    waits, timeout=self.seconds, return_when=asyncio.FIRST_COMPLETED
+                )
+                waits[0].cancel()
+            finally:
+                self.result = await self._call(profiler.stop, getter)
+            logger.info(f"{self.mode} session finished")
+        except Exception as e:
+            logger.error(f"{self.mode} session failed: {e}", exc_info=e)
+            self.error = repr(e)
+        finally:
+            self.end_ts = time.time()
+
+    async def stop(self):
+        """Stop the session early, and wait until its result is ready."""
+        self._stop.set()
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+
+session: Session | None = None
+
+
+def start(mode: str, seconds: float, getter: Getter = None) -> Session:
+    """Start a session of mode for seconds, or until getter finished a refresh, if
+    passed, though at most for seconds."""
+    global session
+    if mode not in MODES:
+        raise ValueError(f"Unknown profiling mode {mode}, expected one of {MODES}")
+    if session is not None and session.running:
+        raise RuntimeError("A profiling session is running already")
+    session = Session(
+        mode, min(seconds, const.PROFILE_MAX_SECONDS), getter and getter.name
+    )
+    session._task = asyncio.create_task(session._run(getter))
+    return session
@@ -1,34 +1,97 @@
+import asyncio
+import concurrent.futures
 import datetime
+import functools
 import json
+import queue
+import re
+import threading
+import time
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional
 
 import requests
 from peewee import (
     AutoField,
     CharField,
+    CompositeKey,
     DateTimeField,
+    Field,
+    FloatField,
     IntegerField,
     Model,
     SqliteDatabase,
     TextField,
+    Tuple,
+    fn,
 )
+from playhouse.sqlite_ext import FTS5Model, SearchField
 
+import codec
+import const
+import log
+import metrics
 from model import *
 
 database_path = Path("data") / "database"
 database_path.mkdir(parents=True, exist_ok=True)
 storage_path = Path("data") / "storage"
 storage_path.mkdir(parents=True, exist_ok=True)
-main_db = SqliteDatabase(database_path / "main.db")
+
+_query_duration = metrics.histogram(
+    "messagesyncer_db_query_duration_seconds",
+    "Duration of SQL statements, by their first keyword",
+    ("statement",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+_write_batch_duration = metrics.histogram(
+    "messagesyncer_db_write_batch_duration_seconds",
+    "Duration of the transactions of the store writer",
+)
+_write_batch_size = metrics.histogram(
+    "messagesyncer_db_write_batch_size",
+    "Writes grouped into a transaction by the store writer",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
 
 
-class StructField(TextField):
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    """Records the duration of every statement in metrics."""
+
+    def execute_sql(self, sql, *args, **kwargs):
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        with _query_duration.time(statement):
+            return super().execute_sql(sql, *args, **kwargs)
+
+
+main_db = InstrumentedSqliteDatabase(
+    database_path / "main.db",
+    timeout=const.DB_BUSY_TIMEOUT,
+    pragmas={
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": const.DB_MMAP_SIZE,
+    },
+)
+
+# Older SQLite builds limit a statement to 999 host parameters.
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+
+class StructField(Field):
+    """A Struct in codec's encoding, decoded only when its content is used.
+
+    Content stored as JSON by older versions is read too, and converted by
+    reencode_articles.
+    """
+
+    field_type = "TEXT"
+
     def db_value(self, value: Struct):
-        return json.dumps(value.asdict(), ensure_ascii=False)
+        return codec.encode(value)
 
     def python_value(self, value):
-        return Struct(dict_=json.loads(value))
+        return Struct.lazy(functools.partial(codec.decode, value))
 
 
 class Article(Model):
@@ -39,6 +102,10 @@ class Article(Model):
 
     class Meta:
         database = main_db
+        indexes = (
+            (("ts", "id"), False),
+            (("userId", "ts", "id"), False),
+        )
 
     @classmethod
     def from_getresult(cls, id: str, getresult: GetResult) -> "Article":
@@ -47,14 +114,515 @@ class Article(Model):
         )
 
 
+class ArticleSearch(FTS5Model):
+    """Full-text index of Article, by userId and the plain text of content.
+
+    Rows share the rowid of their Article.
+    """
+
+    id = SearchField(unindexed=True)
+    userId = SearchField()
+    text = SearchField()
+
+    class Meta:
+        database = main_db
+        table_name = "article_search"
+        # Matches substrings, so languages written without spaces work too
+        options = {"tokenize": "trigram"}
+
+
+def _index_articles(articles: list[tuple[str, Struct]]):
+    """Add stored articles, given as (id, content), to ArticleSearch."""
+    main_db.cursor().executemany(
+        "INSERT OR REPLACE INTO article_search (rowid, id, userId, text) "
+        "SELECT rowid, id, userId, ? FROM article WHERE id = ?",
+        [(str(content), id_) for id_, content in articles],
+    )
+
+
+class Outbox(Model):
+    """A pending delivery of an article to a pusher. Delivered entries are deleted."""
+
+    PENDING = "pending"
+    DEAD = "dead"
+
+    id = AutoField()
+    article = TextField(null=False, index=True)
+    pusher = TextField(null=False)
+    state = TextField(null=False, default=PENDING, index=True)
+    attempts = IntegerField(null=False, default=0)
+    next_attempt_ts = FloatField(null=False, default=0)
+    last_error = TextField(null=True)
+    # Seconds the last failed attempt took, in total and by stage of the push (JSON)
+    last_attempt_duration = FloatField(null=True)
+    last_attempt_stages = TextField(null=True)
+    created_ts = FloatField(null=False, default=time.time)
+
+    class Meta:
+        database = main_db
+        indexes = ((("state", "pusher", "id"), False),)
+
+
+def outbox_heads() -> list[Outbox]:
+    """The first pending entry of each destination."""
+    first_ids = (
+        Outbox.select(fn.MIN(Outbox.id))
+        .where(Outbox.state == Outbox.PENDING)
+        .group_by(Outbox.pusher)
+    )
+    return list(Outbox.select().where(Outbox.id.in_(first_ids)))
+
+
+def pending_outbox_entries(pusher: str, limit: int) -> list[Outbox]:
+    """The first limit pending entries of the destination pusher, in order."""
+    query = Outbox.select().where(
+        (Outbox.state == Outbox.PENDING) & (Outbox.pusher == pusher)
+    )
+    return list(query.order_by(Outbox.id).limit(limit))
+
+
+class RefreshHistory(Model):
+    """A refresh of a getter: how long its stages took and what it did. Only the
+    latest const.REFRESH_HISTORY_MAXLENGTH refreshes of each getter are kept."""
+
+    SUCCESS = "success"
+    FAILURE = "failure"
+
+    id = AutoField()
+    getter = TextField(null=False)
+    start_ts = FloatField(null=False)
+    duration = FloatField(null=False)
+    outcome = TextField(null=False)
+    error = TextField(null=True)
+    stages = TextField(null=False, default="{}")  # JSON, seconds by stage
+    counts = TextField(null=False, default="{}")  # JSON
+
+    class Meta:
+        database = main_db
+        indexes = ((("getter", "id"), False),)
+
+
+def save_refresh_history(
+    getter: str,
+    start_ts: float,
+    duration: float,
+    outcome: str,
+    error: str = None,
+    stages: dict[str, float] = {},
+    counts: dict[str, int] = {},
+):
+    """Record a refresh of getter, dropping its oldest records beyond the limit."""
+    RefreshHistory.create(
+        getter=getter,
+        start_ts=start_ts,
+        duration=duration,
+        outcome=outcome,
+        error=error,
+        stages=json.dumps(stages),
+        counts=json.dumps(counts),
+    )
+    oldest_kept = (
+        RefreshHistory.select(RefreshHistory.id)
+        .where(RefreshHistory.getter == getter)
+        .order_by(RefreshHistory.id.desc())
+        .limit(1)
+        .offset(const.REFRESH_HISTORY_MAXLENGTH - 1)
+        .scalar()
+    )
+    if oldest_kept is not None:
+        RefreshHistory.delete().where(
+            (RefreshHistory.getter == getter) & (RefreshHistory.id < oldest_kept)
+        ).execute()
+
+
+def query_refresh_history(
+    getter: str, before: int = None, limit: int = 20
+) -> list[RefreshHistory]:
+    """Return up to limit refreshes of getter, latest first, with ids below before."""
+    query = RefreshHistory.select().where(RefreshHistory.getter == getter)
+    if before is not None:
+        query = query.where(RefreshHistory.id < before)
+    return list(query.order_by(RefreshHistory.id.desc()).limit(limit))
+
+
+def save_article(
+    id: str, getresult: GetResult, pushers: list[str] = []
+) -> list[Outbox]:
+    """Store an article, if it isn't stored yet, together with a pending delivery
+    to each of pushers. Both are written in one transaction."""
+    with main_db.atomic():
+        if not Article.get_or_none(Article.id == id):
+            Article.from_getresult(id, getresult).save(force_insert=True)
+            _index_articles([(id, getresult.content)])
+        return [Outbox.create(article=id, pusher=pusher) for pusher in pushers]
+
+
+def existing_article_ids(ids: list[str]) -> set[str]:
+    """Return the subset of ids which are already stored, using one query per chunk."""
+    ids = list(dict.fromkeys(ids))
+    result = set()
+    for i in range(0, len(ids), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = ids[i : i + SQLITE_MAX_VARIABLE_NUMBER]
+        query = Article.select(Article.id).where(Article.id.in_(chunk)).tuples()
+        result.update(id_ for (id_,) in query)
+    return result
+
+
+def query_articles(
+    user_id: str = None,
+    since: int = None,
+    until: int = None,
+    before: tuple[int, str] = None,
+    limit: int = 10,
+    offset: int = 0,
+) -> list[Article]:
+    """Return up to limit articles, newest first, optionally only those of user_id
+    and with since <= ts < until.
+
+    Articles are ordered by (ts, id), so passing the (ts, id) of the last article
+    returned as before continues right after it, at the cost of an index lookup.
+    """
+    query = Article.select()
+    if user_id is not None:
+        query = query.where(Article.userId == user_id)
+    if since is not None:
+        query = query.where(Article.ts >= since)
+    if until is not None:
+        query = query.where(Article.ts < until)
+    if before is not None:
+        query = query.where(Tuple(Article.ts, Article.id) < Tuple(*before))
+    query = query.order_by(Article.ts.desc(), Article.id.desc())
+    return list(query.limit(limit).offset(offset))
+
+
+def _quote_word(word: str) -> str:
+    return '"' + word.replace('"', '""') + '"'
+
+
+def _highlight(text: str, words: list[str], width: int = None) -> str:
+    """Mark words in text, cropped to width characters around the first one."""
+    words = [word for word in words if "*" not in word]
+    prefix = suffix = ""
+    if width is not None:
+        lowered = text.lower()
+        positions = [lowered.find(word.lower()) for word in words]
+        start = max(0, min((p for p in positions if p >= 0), default=0) - width // 2)
+        prefix = "…" if start else ""
+        suffix = "…" if start + width < len(text) else ""
+        text = text[start : start + width]
+    if words:
+        pattern = "|".join(re.escape(word) for word in words)
+        text = re.sub(pattern, lambda m: f"**{m.group()}**", text, flags=re.I)
+    return prefix + text + suffix
+
+
+def search_articles(
+    query: str, limit: int = 10, offset: int = 0
+) -> list[tuple[Article, str]]:
+    """Return articles matching all words of query, best matches first, each with
+    a snippet of its text in which the words are marked **like this**.
+
+    Words shorter than 3 characters can't use the trigram index, so they are only
+    matched by scanning the indexed texts, and a query of only such words is ordered
+    by time.
+    """
+    words = query.split()
+    indexed = [word for word in words if len(word) >= 3]
+    short = [word for word in words if len(word) < 3]
+    if not words:
+        return []
+
+    if indexed:
+        snippet = fn.snippet(
+            ArticleSearch._meta.entity, 2, "**", "**", "…", const.SEARCH_SNIPPET_LENGTH
+        )
+    else:
+        snippet = ArticleSearch.text
+    select = Article.select(Article, snippet.alias("snippet")).join(
+        ArticleSearch, on=(ArticleSearch.id == Article.id)
+    )
+    if indexed:
+        select = select.where(
+            ArticleSearch.match(" ".join(_quote_word(word) for word in indexed))
+        ).order_by(ArticleSearch.rank())
+    else:
+        select = select.order_by(Article.ts.desc(), Article.id.desc())
+    for word in short:
+        select = select.where(
+            ArticleSearch.text.contains(word) | ArticleSearch.userId.contains(word)
+        )
+
+    results = []
+    for article in select.limit(limit).offset(offset).objects():
+        if indexed:
+            snippet = _highlight(article.snippet, short)
+        else:
+            snippet = _highlight(article.snippet, short, const.SEARCH_SNIPPET_LENGTH)
+        results.append((article, snippet))
+    return results
+
+
+def backfill_search(batch_size: int = 1000, progress: Callable[[int], None] = None):
+    """Index all stored articles in ArticleSearch, for databases created before it.
+
+    Can run while MessageSyncer runs, and be interrupted and run again.
+    """
+    last_rowid = 0
+    done = 0
+    while True:
+        rows = main_db.execute_sql(
+            "SELECT rowid, id, content FROM article WHERE rowid > ? "
+            "ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return done
+        articles = [(id_, Article.content.python_value(c)) for _, id_, c in rows]
+        write(_index_articles, articles)
+        last_rowid = rows[-1][0]
+        done += len(rows)
+        if progress:
+            progress(done)
+
+
+def _update_contents(contents: list[tuple[bytes, int]]):
+    main_db.cursor().executemany(
+        "UPDATE article SET content = ? WHERE rowid = ?", contents
+    )
+
+
+def reencode_articles(
+    batch_size: int = 1000, progress: Callable[[int], None] = None
+) -> int:
+    """Convert the content of articles stored as JSON to codec's encoding.
+
+    Can run while MessageSyncer runs, and be interrupted and run again.
+    """
+    last_rowid = 0
+    done = 0
+    while True:
+        rows = main_db.execute_sql(
+            "SELECT rowid, content FROM article "
+            "WHERE rowid > ? AND typeof(content) = 'text' ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return done
+        encoded = [
+            (codec.encode(Struct(dict_=json.loads(content))), rowid)
+            for rowid, content in rows
+        ]
+        write(_update_contents, encoded)
+        last_rowid = rows[-1][0]
+        done += len(rows)
+        if progress:
+            progress(done)
+
+
 class ImageStorage(Model):
     id = TextField(primary_key=True, null=False)
-    filename = TextField(null=False)
+    filename = TextField(null=False, index=True)
     mime = TextField(null=False)
 
     class Meta:
         database = main_db
 
 
+class ImageFile(Model):
+    """An image in data/pic, stored by the sha256 digest of its content."""
+
+    digest = TextField(primary_key=True, null=False)
+    filename = TextField(null=False, index=True)  # Relative to data/pic
+    size = IntegerField(null=False)
+    created_ts = FloatField(null=False, default=time.time)
+    accessed_ts = FloatField(null=False, default=time.time, index=True)
+
+    class Meta:
+        database = main_db
+
+
+class ImageVariant(Model):
+    """An image converted from the image with digest by operation (ImageOperation.key)."""
+
+    digest = TextField(null=False, index=True)
+    operation = TextField(null=False)
+    filename = TextField(null=False)  # Relative to data/pic
+    size = IntegerField(null=False)
+    created_ts = FloatField(null=False, default=time.time)
+
+    class Meta:
+        database = main_db
+        primary_key = CompositeKey("digest", "operation")
+
+
+class ImageURL(Model):
+    """The image last downloaded from a URL."""
+
+    url = TextField(primary_key=True, null=False)
+    digest = TextField(null=False, index=True)
+    etag = TextField(null=True)
+    last_modified = TextField(null=True)
+    fetched_ts = FloatField(null=False, default=time.time)
+
+    class Meta:
+        database = main_db
+
+
+def _migration_1(db: SqliteDatabase):
+    """Index image links by filename, and articles by time and user."""
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS imagestorage_filename ON imagestorage (filename)"
+    )
+    db.execute_sql("CREATE INDEX IF NOT EXISTS article_ts_id ON article (ts, id)")
+    db.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "article_userId_ts_id" ON article ("userId", ts, id)'
+    )
+
+
+def _migration_2(db: SqliteDatabase):
+    """Index pending deliveries by destination."""
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS outbox_state_pusher_id ON outbox (state, pusher, id)"
+    )
+
+
+def _add_columns(db: SqliteDatabase, table: str, columns: dict[str, str]):
+    """Add those of columns, types by name, which table doesn't have yet. Tables are
+    created with the latest schema before migrations run, so they may have them."""
+    existing = {column.name for column in db.get_columns(table)}
+    for name, type_ in columns.items():
+        if name not in existing:
+            db.execute_sql(f"ALTER TABLE {table} ADD COLUMN {name} {type_}")
+
+
+def _migration_3(db: SqliteDatabase):
+    """Record how long the last failed delivery attempt took."""
+    _add_columns(
+        db, "outbox", {"last_attempt_duration": "REAL", "last_attempt_stages": "TEXT"}
+    )
+
+
+# Schema changes of existing databases, in order. The schema version of a database,
+# stored in PRAGMA user_version, is the number of migrations applied to it. Only
+# ever append to this list; new databases are created with the latest schema.
+MIGRATIONS = [_migration_1, _migration_2, _migration_3]
+
+
+def migrate(db: SqliteDatabase, new: bool = False):
+    """Bring db to the latest schema version. A new db is only marked as such."""
+    if new:
+        db.execute_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        return
+    (version,) = db.execute_sql("PRAGMA user_version").fetchone()
+    for i in range(version, len(MIGRATIONS)):
+        with db.atomic():
+            MIGRATIONS[i](db)
+            db.execute_sql(f"PRAGMA user_version = {i + 1}")
+
+
+_new_database = not main_db.get_tables()
 Article.create_table()
+ArticleSearch.create_table()
 ImageStorage.create_table()
+ImageVariant.create_table()
+ImageFile.create_table()
+ImageURL.create_table()
+Outbox.create_table()
+RefreshHistory.create_table()
+migrate(main_db, new=_new_database)
+
+
+class Writer:
+    """A thread doing all writes to db, so they never wait for each other's locks.
+
+    Writes queued while a transaction runs are grouped into the next one, each in a
+    savepoint of its own, so a failing write doesn't undo the others.
+    """
+
+    def __init__(self, db: SqliteDatabase) -> None:
+        self.db = db
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < const.DB_WRITE_BATCHSIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [write for write in batch if write is not None]
+            if batch:
+                self._write(batch)
+            if stop:
+                self.db.close()
+                return
+
+    def _write(self, batch: list):
+        results = []
+        _write_batch_size.observe(len(batch))
+        start_time = time.perf_counter()
+        try:
+            with self.db.atomic():
+                for function, args, kwargs, future in batch:
+                    try:
+                        with self.db.atomic():
+                            results.append((future, function(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            log.error(f"Failed to commit {len(batch)} writes: {e}", exc_info=e)
+            results = [(future, None, e) for *_, future in batch]
+        _write_batch_duration.observe(time.perf_counter() - start_time)
+        for future, result, exception in results:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="store-writer", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Finish the writes queued so far and stop the thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def submit(self, function, *args, **kwargs) -> concurrent.futures.Future:
+        """Queue function(*args, **kwargs). Its result is set once it's committed."""
+        future = concurrent.futures.Future()
+        if threading.current_thread() is self._thread:
+            # Already inside a transaction of the writer
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self.start()
+        self._queue.put((function, args, kwargs, future))
+        return future
+
+
+writer = Writer(main_db)
+
+
+def write(function, *args, **kwargs):
+    """Run function(*args, **kwargs) on the writer thread and wait until it's committed."""
+    return writer.submit(function, *args, **kwargs).result()
+
+
+async def write_async(function, *args, **kwargs):
+    """Like write, without blocking the running loop."""
+    return await asyncio.wrap_future(writer.submit(function, *args, **kwargs))
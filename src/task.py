@@ -4,11 +4,22 @@ import types
 
 import const
 import log
+import metrics
 
 tasks: dict[str, asyncio.Task] = {}
 tasklist_maxlength = const.TASKLIST_MAXLENGTH
 
 
+def _count_tasks() -> dict[str, int]:
+    done = sum(task.done() for task in list(tasks.values()))
+    return {"running": len(tasks) - done, "done": done}
+
+
+metrics.gauge(
+    "messagesyncer_tasks", "Tracked tasks by state", ("state",), function=_count_tasks
+)
+
+
 def _gc():
     if len(tasks) > tasklist_maxlength:
         completed_tasks = [
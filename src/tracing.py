@@ -0,0 +1,76 @@
+"""Durations of the stages of an operation, like a refresh, and counts of what it did.
+
+An operation runs in trace(), and the code it calls marks its stages with span().
+Tasks and worker loops started from there inherit the trace; outside of one, span()
+only measures. Spans of a stage add up, so stages run concurrently, like details,
+may sum to more than the duration of the operation.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+REFRESH = "refresh"
+DELIVERY = "delivery"
+
+
+class Trace:
+    def __init__(self, name: str, kind: str) -> None:
+        self.name = name
+        self.kind = kind  # REFRESH of the getter name, or DELIVERY to the pusher name
+        self.start_ts = time.time()
+        self.duration: float | None = None
+        self.stages: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, duration: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + duration
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+
+class Span:
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.duration = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._start
+        if (trace_ := current.get()) is not None:
+            trace_.add(self.stage, self.duration)
+
+
+current: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+@contextmanager
+def trace(name: str, kind: str):
+    """Make a new Trace the current one in the with block."""
+    trace_ = Trace(name, kind)
+    token = current.set(trace_)
+    start = time.perf_counter()
+    try:
+        yield trace_
+    finally:
+        trace_.duration = time.perf_counter() - start
+        current.reset(token)
+
+
+def span(stage: str) -> Span:
+    """Add the duration of a with block to stage of the current trace."""
+    return Span(stage)
+
+
+def count(name: str, amount: int = 1):
+    """Count amount of name in the current trace, if any."""
+    if (trace_ := current.get()) is not None:
+        trace_.count(name, amount)
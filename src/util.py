@@ -3,6 +3,8 @@ import dataclasses
 import re
 import shutil
 import subprocess
+import threading
+import uuid
 from pathlib import Path
 from typing import Any, Dict, List, Type, Union
 from urllib.parse import urlparse
@@ -11,6 +13,8 @@ import git
 import requests
 from PIL import Image
 
+import const
+
 
 def generate_function_call_str(function, *args, **kwargs):
     args_str = ", ".join(repr(arg) for arg in args)
@@ -19,12 +23,36 @@ def generate_function_call_str(function, *args, **kwargs):
     return f"{function}({all_args_str})"
 
 
+def truncated_repr(value, max_length: int) -> str:
+    """repr() of value, cut to about max_length characters."""
+    if isinstance(value, (str, bytes)) and len(value) > max_length:
+        return f"{repr(value[:max_length])}...({len(value)} in total)"
+    text = repr(value)
+    if len(text) > max_length:
+        return f"{text[:max_length]}...({len(text)} in total)"
+    return text
+
+
+# Sessions aren't thread-safe, so each thread keeps one to reuse its connections
+_download_sessions = threading.local()
+
+
 def download(url, path: Path):
-    response = requests.get(url, proxies={})
-    if response.status_code == 200:
-        path.write_bytes(response.content)
-    else:
-        raise Exception(f"Download failed: {response.status_code}")
+    """Download url to path. The body is written to a temporary file next to path as
+    it arrives, which then replaces path, so path is never left half-written."""
+    if (session := getattr(_download_sessions, "session", None)) is None:
+        session = _download_sessions.session = requests.Session()
+    temp_path = path.with_name(f".download-{uuid.uuid4().hex}")
+    try:
+        with session.get(url, proxies={}, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"Download failed: {response.status_code}")
+            with temp_path.open("wb") as f:
+                for chunk in response.iter_content(const.IMAGE_DOWNLOAD_CHUNKSIZE):
+                    f.write(chunk)
+        temp_path.replace(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
 
 
 async def download_async(url, path: Path):
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+workdir = None
+
+
+def pytest_sessionstart(session):
+    # Modules of src create and open data/ in the working directory as they're
+    # imported, which test modules do as they're collected, right after this. So
+    # they're only imported in here once the tests left data/ of the instance.
+    global workdir
+    workdir = tempfile.mkdtemp(prefix="messagesyncer-test-")
+    os.chdir(workdir)
+
+
+def pytest_sessionfinish(session):
+    os.chdir(session.config.invocation_params.dir)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path_factory, monkeypatch):
+    """Give each test a database and an image store of its own."""
+    import const
+    import image
+    import store
+
+    data_path = tmp_path_factory.mktemp("data")
+    database = store.main_db.database
+    store.writer.stop()
+    store.main_db.init(str(data_path / "main.db"), timeout=const.DB_BUSY_TIMEOUT)
+    store.main_db.create_tables(
+        [
+            store.Article,
+            store.ArticleSearch,
+            store.ImageStorage,
+            store.ImageVariant,
+            store.ImageFile,
+            store.ImageURL,
+            store.Outbox,
+            store.RefreshHistory,
+        ]
+    )
+    store.migrate(store.main_db, new=True)
+    monkeypatch.setattr(image, "path", data_path / "pic")
+    image.path.mkdir()
+    yield
+    store.writer.stop()
+    store.main_db.init(database, timeout=const.DB_BUSY_TIMEOUT)
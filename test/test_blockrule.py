@@ -0,0 +1,35 @@
+import random
+import re
+import string
+
+import blockrule
+
+
+def _expected(rules, text):
+    return [rule for rule in dict.fromkeys(rules) if re.search(rule, text)]
+
+
+def test_match_equals_regex_search():
+    random.seed(0)
+    keywords = [
+        "".join(random.choices("abcde", k=random.randint(1, 4))) for _ in range(50)
+    ]
+    rules = keywords + ["foo", "foobar", "^start", r"\d{3}", "a.c", "测试"]
+    compiled = blockrule.BlockRules(rules)
+    texts = ["start foobar 123", "测试内容", ""] + [
+        "".join(random.choices(string.ascii_lowercase + " ", k=40)) for _ in range(200)
+    ]
+    for text in texts:
+        assert compiled.match(text) == _expected(rules, text)
+
+
+def test_invalid_regex_is_used_as_keyword():
+    compiled = blockrule.BlockRules(["[ad", "java"])
+    assert compiled.match("[ad sale") == ["[ad"]
+    assert compiled.match("ad sale") == []
+
+
+def test_get_compiled_reuses_compiled_rules():
+    rules = ["a", "b"]
+    assert blockrule.get_compiled(rules) is blockrule.get_compiled(list(rules))
+    assert blockrule.get_compiled(["a"]).rules == ("a",)
@@ -0,0 +1,34 @@
+import json
+
+import codec
+from model.struct import *
+
+
+def make_struct(text: str) -> Struct:
+    struct = Struct.template1(text, 0, title="Title", images=["a.png", "b.png"])
+    struct.content.append(StructTitle("heading", bold=True, heading=2))
+    struct.content.append(StructURL("https://example.com", StructText("link")))
+    return struct
+
+
+def test_roundtrip():
+    for text in ["short", "long " * 1000]:
+        struct = make_struct(text)
+        encoded = codec.encode(struct)
+        assert encoded[0] == (
+            codec.FORMAT_MSGPACK
+            if text == "short"
+            else (
+                codec.FORMAT_MSGPACK_ZSTD
+                if codec.zstandard
+                else codec.FORMAT_MSGPACK_ZLIB
+            )
+        )
+        assert codec.decode(encoded) == struct.content
+
+
+def test_decode_json():
+    struct = Struct().text("text").image("a.png")
+    stored = json.dumps(struct.asdict(), ensure_ascii=False)
+    assert codec.decode(stored) == struct.content
+    assert codec.decode(stored.encode()) == struct.content
@@ -0,0 +1,28 @@
+import os
+
+import config
+
+
+def test_value_is_cached_until_file_changes(tmp_path):
+    manager = config.HotReloadConfigManager(tmp_path / "main.yaml", config.MainConfig)
+
+    value = manager.value
+    version = manager.version
+    assert manager.value is value
+    assert manager.version == version
+
+    # Changes made through the manager invalidate the cache immediately.
+    new = manager.dict
+    new["policy"]["article_max_ageday"] = 1
+    manager.save_dict(new)
+    assert manager.value.policy.article_max_ageday == 1
+    assert manager.version == version + 1
+
+    # Changes made by others are noticed by mtime and size.
+    text = manager.path.read_text("utf-8").replace(
+        "article_max_ageday: 1", "article_max_ageday: 22"
+    )
+    manager.path.write_text(text, "utf-8")
+    stat = manager.path.stat()
+    os.utime(manager.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert manager.value.policy.article_max_ageday == 22
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import engine
+
+
+def test_loop_pool_affinity():
+    pool = engine.LoopPool("test", 3)
+
+    async def current_thread():
+        return threading.current_thread()
+
+    async def main():
+        threads = {key: await pool.run(current_thread(), key=key) for key in "abcdef"}
+        for key, thread in threads.items():
+            assert await pool.run(current_thread(), key=key) is thread
+            assert thread is not threading.current_thread()
+
+    try:
+        asyncio.run(main())
+    finally:
+        pool.stop()
+
+
+def test_thread_safe_semaphore():
+    pool = engine.LoopPool("test", 4)
+    semaphore = engine.ThreadSafeSemaphore(2)
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    async def work():
+        nonlocal running, max_running
+        async with semaphore:
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            with lock:
+                running -= 1
+
+    async def main():
+        await asyncio.gather(*[pool.run(work(), key=str(i)) for i in range(20)])
+
+    try:
+        asyncio.run(main())
+    finally:
+        pool.stop()
+    assert max_running == 2
+    assert semaphore._value == 2
@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import os
+import uuid
+
+import httpx
+import pytest
+from PIL import Image
+
+import image
+import store
+
+
+def test_download_withcache(monkeypatch):
+    requests = []
+    etag = '"v1"'
+
+    async def handler(request: httpx.Request):
+        requests.append(request)
+        await asyncio.sleep(0.01)
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304)
+        if request.url.host == "other.test":
+            return httpx.Response(200, content=b"second image")
+        return httpx.Response(200, content=b"first image", headers={"etag": etag})
+
+    async def main():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(image.network, "client", lambda use_proxies=True: client)
+
+        # Same file name, different content, different files
+        token = uuid.uuid4().hex
+        url = f"http://host.test/{token}/a.png"
+        other = f"http://other.test/{token}/a.png"
+        results = await asyncio.gather(
+            *[image.download_withcache(url) for _ in range(5)]
+        )
+        path = results[0][0]
+        other_path = (await image.download_withcache(other))[0]
+        assert len(requests) == 2
+        assert all(result == (path, True) for result in results)
+        assert path != other_path
+        assert path.read_bytes() == b"first image"
+        assert other_path.read_bytes() == b"second image"
+
+        # Same content at another url is stored once
+        assert (await image.download_withcache(url + "?copy"))[0] == path
+
+        # Fresh copies are served from the store, stale ones revalidated
+        assert await image.download_withcache(url) == (path, False)
+        assert len(requests) == 3
+        monkeypatch.setattr(image.const, "IMAGE_REVALIDATE_INTERVAL", 0)
+        assert await image.download_withcache(url) == (path, False)
+        assert requests[-1].headers["if-none-match"] == etag
+
+        # A missing file is downloaded again, unconditionally
+        path.unlink()
+        assert await image.download_withcache(url) == (path, True)
+        assert "if-none-match" not in requests[-1].headers
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_clean_evicts_least_recently_used():
+    token = uuid.uuid4().hex
+    files = []
+    for i in range(4):
+        filename = f"{token[:2]}/{token}{i}.png"
+        (image.path / filename).parent.mkdir(exist_ok=True)
+        (image.path / filename).write_bytes(b"x" * 100)
+        store.ImageFile.create(
+            digest=f"{token}{i}", filename=filename, size=100, accessed_ts=1000 + i
+        )
+        store.ImageURL.create(url=f"http://host.test/{token}{i}", digest=f"{token}{i}")
+        store.ImageStorage.create(id=f"{token}{i}", filename=filename, mime="png")
+        files.append(image.path / filename)
+    store.ImageStorage.create(id=token, filename=f"{token}.png", mime="png")
+
+    # The oldest image is used again, so the next two are evicted
+    image.touch(files[0].relative_to(image.path).as_posix())
+    assert image.clean(max_bytes=250) == (2, 200)
+    assert [f.exists() for f in files] == [True, False, False, True]
+    assert not store.ImageURL.get_or_none(store.ImageURL.digest == f"{token}1")
+    assert not store.ImageStorage.get_or_none(store.ImageStorage.id == f"{token}2")
+    assert not store.ImageStorage.get_or_none(store.ImageStorage.id == token)
+    assert store.ImageStorage.get_or_none(store.ImageStorage.id == f"{token}3")
+
+    # Expired, but the recently used image is kept
+    assert image.clean(max_age=1) == (1, 100)
+    assert [f.exists() for f in files] == [True, False, False, False]
+
+
+def test_register_untracked():
+    # Downloaded before the content-addressed store, one of them stored again since
+    (image.path / "old.png").write_bytes(b"old")
+    os.utime(image.path / "old.png", (1000, 1000))
+    (image.path / "copy.png").write_bytes(b"stored")
+    (image.path / ".download-1").write_bytes(b"partial")
+    (image.path / "ab").mkdir()
+    (image.path / "ab/stored.png").write_bytes(b"stored")
+    store.ImageFile.create(
+        digest=hashlib.sha256(b"stored").hexdigest(), filename="ab/stored.png", size=6
+    )
+    store.ImageStorage.create(id="copy", filename="copy.png", mime="png")
+
+    assert image.register_untracked() == 1
+    old = store.ImageFile.get(store.ImageFile.filename == "old.png")
+    assert (old.digest, old.size) == (hashlib.sha256(b"old").hexdigest(), 3)
+    assert old.accessed_ts == 1000
+    assert not (image.path / "copy.png").exists()
+    assert store.ImageStorage.get_by_id("copy").filename == "ab/stored.png"
+    assert image.register_untracked() == 0
+
+    assert image.clean(max_age=1) == (1, 3)
+    assert not (image.path / "old.png").exists()
+
+
+def test_clean_counts_variants():
+    files = []
+    for i in range(3):
+        filename = f"ab/{i}.png"
+        (image.path / filename).parent.mkdir(exist_ok=True)
+        (image.path / filename).write_bytes(b"x" * 100)
+        store.ImageFile.create(
+            digest=str(i), filename=filename, size=100, accessed_ts=1000 + i
+        )
+        files.append(image.path / filename)
+    # The oldest image has two variants, which bring the images over the budget
+    for operation in ("small", "jpeg"):
+        filename = f"ab/0.{operation}.jpg"
+        (image.path / filename).write_bytes(b"x" * 50)
+        store.ImageVariant.create(
+            digest="0", operation=operation, filename=filename, size=50
+        )
+        files.append(image.path / filename)
+
+    assert image.clean(max_bytes=300) == (1, 200)
+    assert [f.exists() for f in files] == [False, True, True, False, False]
+    assert not store.ImageVariant.select().exists()
+    assert image.clean(max_bytes=200) == (0, 0)
+
+
+def test_convert_caches_variants():
+    source = image.path / f".test-{uuid.uuid4().hex}.png"
+    Image.new("RGB", (400, 200), (255, 0, 0)).save(source)
+    operation = image.ImageOperation(format="JPEG", max_width=100, quality=80)
+    try:
+        converted = image.convert_sync(source, operation)
+        with Image.open(converted) as img:
+            assert (img.format, img.size) == ("JPEG", (100, 50))
+        mtime = converted.stat().st_mtime_ns
+        assert asyncio.run(image.convert(source, operation)) == converted
+        assert converted.stat().st_mtime_ns == mtime
+        assert image.to_png(source) != converted
+    finally:
+        image.shutdown_process_pool()
+        source.unlink()
+
+
+def test_webp2png():
+    source = image.path / "a.webp"
+    Image.new("RGB", (40, 20), (0, 0, 255)).save(source, "WEBP")
+    try:
+        png = image.to_png(source)
+        with Image.open(source) as img:
+            assert img.format == "WEBP"
+        assert image.webp2png(source) == source
+        with Image.open(source) as img:
+            assert (img.format, img.size) == ("PNG", (40, 20))
+        assert source.read_bytes() == png.read_bytes()
+    finally:
+        image.shutdown_process_pool()
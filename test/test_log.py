@@ -0,0 +1,76 @@
+import json
+import logging
+
+import log
+
+
+def test_log_buffer():
+    buffer = log.LogBuffer(5)
+    for i in range(8):
+        record = logging.LogRecord(
+            "a.b" if i % 2 else "a", logging.INFO if i % 3 else logging.WARNING,
+            "", 0, f"message {i}", None, None,
+        )  # fmt: skip
+        record.created = 1000 + i
+        buffer.append(record, record.getMessage())
+
+    def seqs(**kwargs):
+        return [entry.seq for entry in buffer.query(**kwargs)]
+
+    assert seqs() == [8, 7, 6, 5, 4]
+    assert seqs(before=7, limit=2) == [6, 5]
+    assert seqs(after=5) == [6, 7, 8]
+    assert seqs(after=0, before=6) == [4, 5]
+    assert seqs(level=logging.WARNING) == [7, 4]
+    assert seqs(name="a.b") == [8, 6, 4]
+    assert seqs(name="a", since=1004, until=1006, offset=1) == [5]
+    assert str(buffer.query(limit=1)[0]).endswith("[INFO][a.b] message 7")
+
+
+def test_json_formatter():
+    record = logging.makeLogRecord(
+        {"name": "network", "msg": "GET %s", "args": ("url",), "request_id": 3}
+    )
+    entry = json.loads(log.JSONFormatter().format(record))
+    assert entry["message"] == "GET url"
+    assert entry["request_id"] == 3
+    assert entry["name"] == "network"
+
+
+def test_rotating_file_handler(tmp_path):
+    handler = log.RotatingFileHandler(
+        str(tmp_path / "test.log"), max_bytes=100, backup_count=2, interval=0
+    )
+    for i in range(20):
+        handler.emit(logging.makeLogRecord({"msg": "x" * 30}))
+    handler.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "test.log",
+        "test.log.1",
+        "test.log.2",
+    ]
+
+
+def test_init(tmp_path, monkeypatch):
+    import config
+
+    logging_config = config.MainConfig()
+    logging_config.logging.file_format = "jsonl"
+    with monkeypatch.context() as m:
+        m.setattr(config, "main", lambda: logging_config)
+        m.setattr(log, "path", tmp_path)
+        log.init()
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log.getLogger("test.init").error("failed %s", "here", exc_info=True)
+        log.stop_listener()
+    log.init()
+
+    entry = log.records.query(name="test.init", limit=1)[0]
+    assert entry.message.startswith("failed here\nTraceback")
+    assert str(entry).endswith("[ERROR][test.init] " + entry.message)
+    (line,) = (tmp_path / "root.jsonl").read_text(encoding="utf-8").splitlines()
+    logged = json.loads(line)
+    assert logged["message"] == "failed here"
+    assert "ValueError: boom" in logged["exception"]
@@ -78,6 +78,15 @@ async def _refresh():
     assert article
     assert article.content.asdict() == test_content_start.asdict()
 
+    history = store.query_refresh_history(core.registered_getters[0].name, limit=1)[0]
+    assert history.outcome == store.RefreshHistory.SUCCESS
+    assert json.loads(history.counts) == {
+        "listed": 1, "new": 1, "articles": 1, "deliveries": 1,
+    }  # fmt: skip
+    assert {"list", "lookup", "detail", "store", "deliver", "push.send"} <= set(
+        json.loads(history.stages)
+    )
+
 
 def test_refresh():
     asyncio.run(_refresh())
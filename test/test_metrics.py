@@ -0,0 +1,47 @@
+import pytest
+
+import metrics
+
+
+def test_counter_and_gauge():
+    counter = metrics.Counter("test_total", "Help", ("a", "b"))
+    counter.inc("x", 'q"uote')
+    counter.inc("x", 'q"uote', amount=2)
+    counter.inc("y", "z")
+    assert counter.render().splitlines() == [
+        "# HELP test_total Help",
+        "# TYPE test_total counter",
+        'test_total{a="x",b="q\\"uote"} 3',
+        'test_total{a="y",b="z"} 1',
+    ]
+
+    gauge = metrics.Gauge("test", "Help", ("state",), function=lambda: {"a": 2})
+    assert gauge.render().splitlines()[-1] == 'test{state="a"} 2'
+
+
+def test_histogram():
+    histogram = metrics.Histogram("test_seconds", "Help", ("op",), buckets=(1, 2))
+    for value in [0.5, 1, 1.5, 5]:
+        histogram.observe(value, "get")
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{op="get",le="1.0"} 2',
+        'test_seconds_bucket{op="get",le="2.0"} 3',
+        'test_seconds_bucket{op="get",le="+Inf"} 4',
+        'test_seconds_count{op="get"} 4',
+        'test_seconds_sum{op="get"} 8.0',
+    ]
+
+
+def test_registry():
+    counter = metrics.counter("test_registry_total", "Help")
+    assert metrics.counter("test_registry_total", "Help") is counter
+    counter.inc()
+    assert "\ntest_registry_total 1\n" in metrics.render()
+
+
+def test_metric_needs_samples():
+    class Incomplete(metrics.Metric):
+        type_ = "gauge"
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Lacks samples")
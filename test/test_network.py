@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import httpx
+import pytest
+import requests
+
+import config
+import core
+import engine
+import network
+import tracing
+
+
+def test_client_is_shared_per_loop():
+    async def get_client():
+        return network.client(), network.client(), network.client(use_proxies=False)
+
+    async def main():
+        client, same, unproxied = await get_client()
+        assert client is same
+        assert client is not unproxied
+        await network.close_clients()
+        return client
+
+    assert asyncio.run(main()) is not asyncio.run(main())
+
+
+def test_host_limited_transport():
+    running = 0
+    max_running = 0
+
+    async def handler(request: httpx.Request):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return httpx.Response(200, text=request.url.host)
+
+    async def main():
+        transport = network.HostLimitedTransport(httpx.MockTransport(handler), 2)
+        async with httpx.AsyncClient(transport=transport) as client:
+            responses = await asyncio.gather(
+                *[client.get(f"http://host{i % 2}.test/") for i in range(10)]
+            )
+        assert [r.text for r in responses] == [f"host{i % 2}.test" for i in range(10)]
+
+    asyncio.run(main())
+    assert max_running == 4
+
+
+def test_instrumented_transport_retries(monkeypatch):
+    monkeypatch.setattr(network.const, "HTTP_RETRY_BACKOFF", 0)
+    attempts = []
+
+    async def handler(request: httpx.Request):
+        attempts.append(request.method)
+        if len(attempts) < 3:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200)
+
+    async def main():
+        transport = network.InstrumentedTransport(httpx.MockTransport(handler), 2)
+        async with httpx.AsyncClient(transport=transport) as client:
+            assert (await client.post("http://host.test/", content=b"x")).is_success
+            attempts.clear()
+            with pytest.raises(httpx.ConnectError):
+                await network.InstrumentedTransport(
+                    httpx.MockTransport(handler), 1
+                ).handle_async_request(httpx.Request("GET", "http://host.test/"))
+
+    asyncio.run(main())
+    assert attempts == ["GET", "GET"]
+
+
+def test_requests_keep_proxies_of_config(monkeypatch):
+    proxied_config = config.MainConfig()
+    proxied_config.network.proxies = {"https": "http://proxy.test:1"}
+    monkeypatch.setattr(config, "main", lambda: proxied_config)
+    monkeypatch.setenv("HTTP_PROXY", "http://env.test:2")
+    proxies = network._process_proxy({})["proxies"]
+    requests.Session().merge_environment_settings(
+        "http://host.test/", proxies, None, None, None
+    )
+    assert proxied_config.network.proxies == {"https": "http://proxy.test:1"}
+
+
+def test_requests_on_shared_loop(monkeypatch):
+    delays = []
+    # Whether each attempt fails, in order
+    failures = [True, True, True, False]
+
+    def request(*args, **kwargs):
+        if failures.pop(0):
+            raise requests.ConnectionError("refused")
+        response = requests.Response()
+        response.status_code = 200
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+    monkeypatch.setattr(network, "original_request_method", request)
+    monkeypatch.setattr(network.time, "sleep", delays.append)
+    getter = SimpleNamespace(name="TestBlocking.1", config=None)
+
+    async def call(name: str, kind: str):
+        with tracing.trace(name, kind):
+            return network.requests_proxy(None, "GET", "http://host.test/")
+
+    # Deliveries aren't moved, only refreshes are
+    with pytest.raises(requests.ConnectionError):
+        asyncio.run(call("TestBlocking..", tracing.DELIVERY))
+    assert "TestBlocking.." not in network.blocking_callers
+
+    # On a shared loop, a failed request isn't retried, which would block it
+    assert core.refresh_loop(getter).shared
+    with pytest.raises(requests.ConnectionError):
+        asyncio.run(call(getter.name, tracing.REFRESH))
+    assert delays == []
+    assert getter.name in network.blocking_callers
+
+    worker = core.refresh_loop(getter)
+    try:
+        assert not worker.shared and core.refresh_loop(getter) is worker
+        response = asyncio.run(worker.run(call(getter.name, tracing.REFRESH)))
+        assert response.status_code == 200
+        assert engine.current_worker() is None
+        assert len(delays) == 1 and delays[0] > 0
+    finally:
+        core._dedicated_loops.pop(getter.name).stop()
+        network.blocking_callers.discard(getter.name)
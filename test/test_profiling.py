@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import profiling
+
+held = []
+
+
+def _busy():
+    return sum(i * i for i in range(20000))
+
+
+def _allocate():
+    held.append(bytearray(100000))
+
+
+async def _profile(mode: str, work) -> profiling.Session:
+    session = profiling.start(mode, 10)
+    with pytest.raises(RuntimeError):
+        profiling.start(mode, 10)
+    for _ in range(20):
+        work()
+        await asyncio.sleep(0.005)
+    await session.stop()
+    assert not session.running and session.error is None
+    return session
+
+
+def test_profile():
+    result = asyncio.run(_profile("cprofile", _busy)).result
+    assert "_busy" in result and "cumulative" in result
+
+    result = asyncio.run(_profile("sample", _busy)).result
+    assert "MainThread;" in result
+    assert result.splitlines()[0].rsplit(" ", 1)[1].isdigit()
+
+    result = asyncio.run(_profile("tracemalloc", _allocate)).result
+    assert "test_profiling.py" in result.splitlines()[0]
+
+    with pytest.raises(ValueError):
+        profiling.start("unknown", 1)
+
+
+def test_profiler_needs_stop():
+    class Incomplete(profiling.Profiler):
+        def start(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import threading
+import time
+
+import config
+import core
+import store
+from model import *
+
+
+class PoolPusher(Pusher):
+    instances = 0
+    started = 0
+    closed = 0
+    pushed = []
+
+    def __init__(self, id=None) -> None:
+        super().__init__(id)
+        PoolPusher.instances += 1
+
+    async def start(self) -> None:
+        PoolPusher.started += 1
+
+    async def close(self) -> None:
+        PoolPusher.closed += 1
+
+    async def push(self, content: Struct, to: str = None) -> None:
+        PoolPusher.pushed.append((self.id, to, str(content)))
+
+
+async def _pusher_pool():
+    core.imported_adapter_classes.add(PoolPusher)
+
+    await core.push_to("PoolPusher.a.x", Struct().text("1"))
+    await core.push_to("PoolPusher.a.y", Struct().text("2"))
+    await core.push_to("PoolPusher.b.x", Struct().text("3"))
+    assert PoolPusher.pushed == [("a", "x", "1"), ("a", "y", "2"), ("b", "x", "3")]
+    assert PoolPusher.instances == 2
+    assert PoolPusher.started == 2
+
+    for future in core.close_pushers("PoolPusher"):
+        await asyncio.wrap_future(future)
+    assert PoolPusher.closed == 2
+
+    await core.push_to("PoolPusher.a.x", Struct().text("4"))
+    assert PoolPusher.instances == 3
+
+
+def test_pusher_pool():
+    asyncio.run(_pusher_pool())
+
+
+class SleepingPusher(Pusher):
+    sleeping = threading.Event()
+
+    async def push(self, content: Struct, to: str = None) -> None:
+        SleepingPusher.sleeping.set()
+        time.sleep(0.5)
+
+
+async def _blocking_pusher():
+    core.imported_adapter_classes.update({SleepingPusher, PoolPusher})
+    blocking = asyncio.create_task(core.push_to("SleepingPusher..", Struct()))
+    await asyncio.to_thread(SleepingPusher.sleeping.wait)
+
+    # Pushers of other classes carry on while it blocks its loop
+    start = time.perf_counter()
+    await core.push_to("PoolPusher.c.", Struct().text("unblocked"))
+    assert time.perf_counter() - start < 0.25
+    await blocking
+
+
+def test_blocking_pusher():
+    asyncio.run(_blocking_pusher())
+
+
+class SlowPusher(Pusher):
+    received = []
+
+    async def push(self, content: Struct, to: str = None) -> None:
+        await asyncio.sleep({"slow": 0.1, "hang": 10}.get(to, 0))
+        SlowPusher.received.append((to, str(content)))
+
+
+async def _dispatch():
+    core.imported_adapter_classes.add(SlowPusher)
+    pushers = ["SlowPusher..slow", "SlowPusher..fast", "SlowPusher..hang"]
+
+    results = await asyncio.gather(
+        *[core.dispatch(pushers, Struct().text(str(i))) for i in range(3)]
+    )
+
+    # Every destination got the articles in order
+    for to in ["slow", "fast"]:
+        assert [c for _to, c in SlowPusher.received if _to == to] == ["0", "1", "2"]
+    # and the slow destination didn't hold up the fast one
+    assert SlowPusher.received.index(("fast", "2")) < SlowPusher.received.index(
+        ("slow", "1")
+    )
+    for result in results:
+        errors = {pusher: e for pusher, e in result}
+        assert errors["SlowPusher..slow"] is None
+        assert isinstance(errors["SlowPusher..hang"], asyncio.TimeoutError)
+
+
+def test_dispatch(monkeypatch):
+    test_config = config.MainConfig()
+    test_config.policy.push_timeout = 0.3
+    monkeypatch.setattr(core, "_get_config", lambda: test_config)
+    asyncio.run(_dispatch())
+
+
+class FlakyPusher(Pusher):
+    failures = 1
+    received = []
+
+    async def push(self, content: Struct, to: str = None) -> None:
+        if FlakyPusher.failures > 0:
+            FlakyPusher.failures -= 1
+            raise Exception("flaky")
+        FlakyPusher.received.append(str(content))
+
+
+async def _outbox():
+    core.imported_adapter_classes.add(FlakyPusher)
+    article_id = f"TestPush_{time.time()}"
+    result = GetResult("TestPush", int(time.time()), Struct().text("outbox"))
+
+    entries = store.save_article(article_id, result, ["FlakyPusher.."])
+    await core.deliver(entries)
+    entry = store.Outbox.get_by_id(entries[0].id)
+    assert entry.state == store.Outbox.PENDING
+    assert entry.attempts == 1
+    assert entry.next_attempt_ts > time.time()
+    assert "flaky" in entry.last_error
+    assert (
+        entry.last_attempt_duration
+        >= json.loads(entry.last_attempt_stages)["push.send"]
+    )
+
+    core.requeue_delivery(entry)
+    await core.deliver([entry])
+    assert FlakyPusher.received == ["outbox"]
+    assert store.Outbox.get_or_none(store.Outbox.id == entry.id) is None
+
+    FlakyPusher.failures = 1
+    core._get_config().policy.delivery_max_attempts = 1
+    entries = store.save_article(article_id, result, ["FlakyPusher.."])
+    await core.deliver(entries)
+    assert store.Outbox.get_by_id(entries[0].id).state == store.Outbox.DEAD
+
+
+def test_outbox(monkeypatch):
+    test_config = config.MainConfig()
+    test_config.policy.delivery_max_attempts = 2
+    monkeypatch.setattr(core, "_get_config", lambda: test_config)
+    asyncio.run(_outbox())
+
+
+def test_deliver_due_skips_waiting_destinations(monkeypatch):
+    prefix = f"TestDue{time.time()}"
+    later = time.time() + 3600
+    waiting = [
+        store.Outbox.create(article="a", pusher=f"{prefix}X..", next_attempt_ts=later)
+        for _ in range(3)
+    ]
+    due = store.Outbox.create(article="a", pusher=f"{prefix}Y..")
+    started = {}
+
+    async def deliver_in_order(entries):
+        started[entries[0].pusher] = [entry.id for entry in entries]
+
+    async def run():
+        next_due = core._deliver_due()
+        await asyncio.gather(*core._delivering.values())
+        return next_due
+
+    monkeypatch.setattr(core, "_deliver_in_order", deliver_in_order)
+    monkeypatch.setattr(core.const, "OUTBOX_BATCHSIZE", 3)
+    next_due = asyncio.run(run())
+    assert started[f"{prefix}Y.."] == [due.id]
+    assert f"{prefix}X.." not in started
+    assert next_due is not None and next_due <= later
+    for entry in [*waiting, due]:
+        entry.delete_instance()
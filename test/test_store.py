@@ -0,0 +1,154 @@
+import json
+import time
+
+import store
+from model import *
+
+
+def test_existing_article_ids(monkeypatch):
+    prefix = f"TestStore_{time.time()}_"
+    stored = [prefix + str(i) for i in range(5)]
+    for id_ in stored:
+        store.Article.from_getresult(
+            id_, GetResult("TestStore", int(time.time()), Struct().text(id_))
+        ).save(force_insert=True)
+
+    monkeypatch.setattr(store, "SQLITE_MAX_VARIABLE_NUMBER", 2)
+    queried = stored[::2] + [prefix + "missing"] + stored[::2]
+    assert store.existing_article_ids(queried) == set(stored[::2])
+    assert store.existing_article_ids([]) == set()
+
+
+def test_query_articles():
+    user = f"TestStore_{time.time()}"
+    for i in range(5):
+        store.Article.from_getresult(
+            f"{user}_{i}", GetResult(user, 1000 + i // 2, Struct().text(str(i)))
+        ).save(force_insert=True)
+
+    def ids(articles):
+        return [article.id[-1] for article in articles]
+
+    first = store.query_articles(user_id=user, limit=2)
+    assert ids(first) == ["4", "3"]
+    before = (first[-1].ts, first[-1].id)
+    assert ids(store.query_articles(user_id=user, before=before, limit=2)) == ["2", "1"]
+    assert ids(store.query_articles(user_id=user, since=1001, until=1002)) == ["3", "2"]
+
+
+def test_refresh_history(monkeypatch):
+    monkeypatch.setattr(store.const, "REFRESH_HISTORY_MAXLENGTH", 3)
+    getter = f"TestHistory_{time.time()}"
+    for i in range(5):
+        store.save_refresh_history(getter, i, 1, "success", stages={"list": i})
+    history = store.query_refresh_history(getter)
+    assert [json.loads(entry.stages)["list"] for entry in history] == [4, 3, 2]
+    assert store.query_refresh_history(getter, before=history[0].id, limit=1) == [
+        history[1]
+    ]
+
+
+def test_migrate():
+    db = store.SqliteDatabase(":memory:")
+    db.execute_sql("CREATE TABLE article (id TEXT PRIMARY KEY, userId TEXT, ts INT)")
+    db.execute_sql("CREATE TABLE imagestorage (id TEXT PRIMARY KEY, filename TEXT)")
+    db.execute_sql("CREATE TABLE outbox (id INTEGER PRIMARY KEY, pusher, state)")
+    store.migrate(db)
+    assert "last_attempt_stages" in {column.name for column in db.get_columns("outbox")}
+    assert db.execute_sql("PRAGMA user_version").fetchone() == (len(store.MIGRATIONS),)
+    assert {"article_ts_id", "imagestorage_filename", "outbox_state_pusher_id"} <= {
+        index.name
+        for table in ("article", "imagestorage", "outbox")
+        for index in db.get_indexes(table)
+    }
+    store.migrate(db)
+
+
+def test_migrate_outbox():
+    # The outbox as the first version with one created it
+    db = store.SqliteDatabase(":memory:")
+    db.execute_sql(
+        "CREATE TABLE outbox (id INTEGER NOT NULL PRIMARY KEY, article TEXT NOT NULL, "
+        "pusher TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL, "
+        "next_attempt_ts REAL NOT NULL, last_error TEXT, created_ts REAL NOT NULL)"
+    )
+    db.execute_sql("INSERT INTO outbox VALUES (1, 'a', 'P..', 'dead', 3, 0, 'e', 0)")
+    db.execute_sql("PRAGMA user_version = 2")
+    store.migrate(db)
+    assert db.execute_sql("PRAGMA user_version").fetchone() == (3,)
+    with db.bind_ctx([store.Outbox]):
+        entry = store.Outbox.get_by_id(1)
+    assert (entry.last_error, entry.last_attempt_duration) == ("e", None)
+
+
+def test_migrate_after_create_tables():
+    # A database from before the outbox, opened: tables are created, then migrated
+    db = store.SqliteDatabase(":memory:")
+    db.execute_sql("CREATE TABLE article (id TEXT PRIMARY KEY, userId TEXT, ts INT)")
+    db.execute_sql("CREATE TABLE imagestorage (id TEXT PRIMARY KEY, filename TEXT)")
+    with db.bind_ctx([store.Outbox, store.RefreshHistory]):
+        db.create_tables([store.Outbox, store.RefreshHistory])
+    store.migrate(db)
+    assert db.execute_sql("PRAGMA user_version").fetchone() == (len(store.MIGRATIONS),)
+
+
+def test_writer_isolates_failed_writes():
+    user = f"TestStore_{time.time()}"
+
+    def save(i):
+        store.Article.from_getresult(
+            f"{user}_{i}", GetResult(user, i, Struct().text(str(i)))
+        ).save(force_insert=True)
+        return i
+
+    futures = [store.writer.submit(save, i) for i in [0, 1, 1, 2]]
+    assert [f.exception() is None for f in futures] == [True, True, False, True]
+    assert [f.result() for f in futures if f.exception() is None] == [0, 1, 2]
+    assert store.existing_article_ids([f"{user}_{i}" for i in range(3)]) == {
+        f"{user}_{i}" for i in range(3)
+    }
+    assert store.write(store.write, save, 3) == 3
+
+    store.writer.stop()
+    assert store.write(save, 4) == 4
+
+
+def test_search_articles():
+    user = f"TestSearch{int(time.time() * 1000)}"
+    for i, text in enumerate(["the quick brown fox", "a lazy dog", "quick dog"]):
+        store.save_article(
+            f"{user}_{i}", GetResult(user, 1000 + i, Struct().text(text))
+        )
+
+    def search(query):
+        return [
+            (article.id[-1], snippet)
+            for article, snippet in store.search_articles(f"{user} {query}")
+        ]
+
+    assert search("quick") == [("2", "**quick** dog"), ("0", "the **quick** brown fox")]
+    assert search("dog quick") == [("2", "**quick** **dog**")]
+    assert search("og") == [("2", "quick d**og**"), ("1", "a lazy d**og**")]
+    assert search('"') == []
+
+    store.ArticleSearch.delete().where(store.ArticleSearch.userId == user).execute()
+    assert search("quick") == []
+    store.backfill_search()
+    assert len(search("quick")) == 2
+
+
+def test_reencode_articles():
+    id_ = f"TestStore_json_{time.time()}"
+    struct = Struct().text("stored as json").image("a.png")
+    store.main_db.execute_sql(
+        'INSERT INTO article (id, "userId", ts, content) VALUES (?, ?, ?, ?)',
+        (id_, "TestStore", 0, json.dumps(struct.asdict())),
+    )
+    assert store.Article.get_by_id(id_).content.content == struct.content
+
+    assert store.reencode_articles() >= 1
+    (content,) = store.main_db.execute_sql(
+        "SELECT content FROM article WHERE id = ?", (id_,)
+    ).fetchone()
+    assert isinstance(content, bytes)
+    assert store.Article.get_by_id(id_).content.content == struct.content
@@ -0,0 +1,62 @@
+from model.struct import *
+
+
+def test_lazy_struct():
+    loaded = []
+
+    def loader():
+        loaded.append(True)
+        return [StructText("lazy")]
+
+    struct = Struct.lazy(loader)
+    assert not loaded
+    assert str(struct) == "lazy" and str(struct) == "lazy"
+    assert loaded == [True]
+
+
+def test_struct_caches_renderings():
+    struct = Struct().text("a")
+    assert str(struct) == "a" and struct.asmarkdown() == "a"
+    digest = struct.digest
+
+    struct.text("b")
+    assert str(struct) == "ab"
+    struct.content.append(StructText("c"))
+    assert str(struct) == "abc"
+    assert struct.asdict()[-1] == {
+        "type": "text",
+        "data": {"text": "c", "bold": False, "italic": False},
+    }
+
+    same = Struct(dict_=struct.asdict())
+    assert same == struct and same.digest == struct.digest != digest
+    assert Struct().text("a").digest == digest
+
+
+def test_struct_notices_changed_elements():
+    struct = Struct().text("a").image("http://host.test/a.png")
+    assert struct.asmarkdown() == "a![](http://host.test/a.png)  \n"
+    digest = struct.digest
+
+    struct.content[1].source = "/data/pic/a.png"
+    assert struct.asmarkdown() == "a![](/data/pic/a.png)  \n"
+    assert struct.digest != digest
+
+    # asdict() is the caller's to change
+    struct.asdict()[0]["data"]["text"] = "changed"
+    assert struct.asdict()[0]["data"]["text"] == "a"
+
+
+def test_struct_element_subclass():
+    @dataclass
+    class MarkedText(StructText):
+        mark: str = "!"
+
+        def __str__(self) -> str:
+            return self.text + self.mark
+
+    struct = Struct()
+    struct.content.append(MarkedText("a"))
+    assert str(struct) == "a!"
+    struct.content[0].mark = "?"
+    assert str(struct) == "a?"
@@ -0,0 +1,24 @@
+import asyncio
+
+import tracing
+
+
+async def _stage(name: str):
+    with tracing.span(name):
+        await asyncio.sleep(0.01)
+    tracing.count(name)
+
+
+def test_trace():
+    async def run():
+        with tracing.trace("test", tracing.REFRESH) as trace_:
+            await asyncio.gather(_stage("a"), _stage("a"), _stage("b"))
+        await _stage("outside")
+        return trace_
+
+    trace_ = asyncio.run(run())
+    assert trace_.counts == {"a": 2, "b": 1}
+    assert set(trace_.stages) == {"a", "b"}
+    assert trace_.stages["a"] > trace_.stages["b"] >= 0.01
+    assert trace_.duration >= 0.01
+    assert tracing.current.get() is None
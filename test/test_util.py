@@ -0,0 +1,38 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import util
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/file":
+            self.send_error(404)
+            return
+        body = b"x" * 200_000
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        util.download(f"{base_url}/file", tmp_path / "file")
+        assert (tmp_path / "file").read_bytes() == b"x" * 200_000
+
+        # A failed download leaves neither path nor a temporary file behind
+        with pytest.raises(Exception, match="404"):
+            util.download(f"{base_url}/missing", tmp_path / "missing")
+        assert [p.name for p in tmp_path.iterdir()] == ["file"]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,85 @@
+"""Compare the compiled block rule engine with applying every rule with re.match
+and re.search, as refresh_worker used to do.
+
+The legacy approach is slow enough to only be run on a sample of the articles;
+its total is extrapolated from the sample.
+
+Usage: python tool/bench/block_rules.py [--rules N] [--articles N] [--legacy-sample N]
+"""
+
+import random
+import re
+import string
+import time
+from argparse import ArgumentParser
+
+from common import report, setup_workdir
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--rules", type=int, default=1000)
+    parser.add_argument("--regex-ratio", type=float, default=0.05)
+    parser.add_argument("--articles", type=int, default=10000)
+    parser.add_argument("--article-length", type=int, default=500)
+    parser.add_argument("--legacy-sample", type=int, default=200)
+    return parser.parse_args()
+
+
+def random_word(k):
+    return "".join(random.choices(string.ascii_lowercase, k=k))
+
+
+def main():
+    args = parse_args()
+    setup_workdir()
+
+    import blockrule
+
+    random.seed(0)
+    regex_count = int(args.rules * args.regex_ratio)
+    rules = [
+        random_word(random.randint(4, 10)) for _ in range(args.rules - regex_count)
+    ]
+    rules += [f"{random_word(3)}\\d+{random_word(2)}" for _ in range(regex_count)]
+    articles = [
+        " ".join(
+            random_word(random.randint(2, 9)) for _ in range(args.article_length // 6)
+        )
+        for _ in range(args.articles)
+    ]
+
+    def legacy(text):
+        return [rule for rule in rules if re.match(rule, text) or re.search(rule, text)]
+
+    sample = articles[: args.legacy_sample]
+    start = time.perf_counter()
+    legacy_matches = [legacy(text) for text in sample]
+    legacy_per_article = (time.perf_counter() - start) / len(sample)
+
+    start = time.perf_counter()
+    compiled = blockrule.get_compiled(rules)
+    compile_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = [compiled.match(text) for text in articles]
+    engine_seconds = time.perf_counter() - start
+
+    assert matches[: len(sample)] == legacy_matches
+    report(
+        {
+            "rules": args.rules,
+            "articles": args.articles,
+            "blocked_articles": sum(1 for m in matches if m),
+            "legacy_seconds_per_article": legacy_per_article,
+            "legacy_seconds_extrapolated": legacy_per_article * args.articles,
+            "engine_compile_seconds": compile_seconds,
+            "engine_seconds": engine_seconds,
+            "engine_seconds_per_article": engine_seconds / args.articles,
+            "speedup": legacy_per_article * args.articles / engine_seconds,
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+src_path = Path(__file__).resolve().parents[2] / "src"
+
+
+def setup_workdir():
+    """Run the benchmark in a scratch directory, so data/ of the instance is untouched."""
+    workdir = tempfile.mkdtemp(prefix="messagesyncer-bench-")
+    os.chdir(workdir)
+    if str(src_path) not in sys.path:
+        sys.path.insert(0, str(src_path))
+    return Path(workdir)
+
+
+def quiet_logging():
+    import log
+
+    log.root.setLevel(log.WARNING)
+
+
+def rss_bytes() -> int:
+    """Current resident set size."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def report(result: dict):
+    print(json.dumps(result, indent=2))
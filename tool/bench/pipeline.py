@@ -0,0 +1,226 @@
+"""Run articles end to end through synthetic getters and pushers: registered from
+pairs by core.update_getters, refreshed through core.refresh, stored, and delivered
+through the outbox by the delivery worker, with retries of failed pushes.
+
+Each round, every getter lists --ids new ids, and each one's detail takes
+--detail-latency seconds and holds --payload-size bytes of text and --images image
+elements. Pushes download their images through image.download_list, from a local
+mock transport serving --image-size bytes each, then take --pusher-latency seconds
+and fail with probability --failure-rate. Retried pushes find their images stored.
+
+Reports articles/s, the latency from an id being listed to its successful push,
+the database and image store sizes, RSS and the lag of the main event loop.
+
+Usage: python tool/bench/pipeline.py [--getters N] [--ids N] [--rounds N] ...
+"""
+
+import asyncio
+import random
+import statistics
+import string
+import threading
+import time
+from argparse import ArgumentParser
+
+from common import peak_rss_bytes, quiet_logging, report, rss_bytes, setup_workdir
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--getters", type=int, default=50)
+    parser.add_argument("--ids", type=int, default=20, help="New ids per list")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--detail-latency", type=float, default=0.01)
+    parser.add_argument("--payload-size", type=int, default=2000, help="Bytes")
+    parser.add_argument("--images", type=int, default=2, help="Per article")
+    parser.add_argument("--image-size", type=int, default=20000, help="Bytes")
+    parser.add_argument("--pusher-latency", type=float, default=0.005)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--destinations", type=int, default=4)
+    parser.add_argument("--retry-backoff", type=float, default=0.1, help="Seconds")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[
+        min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    ]
+
+
+class LoopLagMonitor:
+    """Samples how late the running loop wakes up from short sleeps."""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.lags: list[float] = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+
+def main():
+    args = parse_args()
+    workdir = setup_workdir()
+    quiet_logging()
+
+    import httpx
+
+    import config
+    import core
+    import image
+    import store
+    from model import GetResult, Getter, Pusher, Struct
+    from model.struct import StructImage
+
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+    words = ["".join(rng.choices(string.ascii_lowercase, k=7)) for _ in range(1000)]
+    payload = " ".join(rng.choices(words, k=args.payload_size // 8))[
+        : args.payload_size
+    ]
+
+    listed_at: dict[str, float] = {}
+    latencies: list[float] = []
+    failed_pushes = 0
+    image_requests = 0
+
+    async def serve_image(request: httpx.Request) -> httpx.Response:
+        nonlocal image_requests
+        image_requests += 1
+        # Distinct content per URL, so the store keeps every image
+        content = str(request.url).encode().ljust(args.image_size, b"\0")
+        return httpx.Response(200, content=content, headers={"etag": '"bench"'})
+
+    # Pushers run on worker loops, and a client belongs to the loop it's used on
+    image_clients: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
+    def image_client(use_proxies: bool = True) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if (client := image_clients.get(loop)) is None:
+            transport = httpx.MockTransport(serve_image)
+            client = image_clients[loop] = httpx.AsyncClient(transport=transport)
+        return client
+
+    image.network.client = image_client
+
+    class SynthGetter(Getter):
+        async def list(self) -> list[str]:
+            self._round = getattr(self, "_round", -1) + 1
+            ids = [f"{self._round}-{i}" for i in range(args.ids)]
+            now = time.perf_counter()
+            for id_ in ids:
+                listed_at[f"{self.class_name}_{self.id}-{id_}"] = now
+            return [f"{self.id}-{id_}" for id_ in ids]
+
+        async def detail(self, id_: str) -> GetResult:
+            await asyncio.sleep(args.detail_latency)
+            images = [f"https://img.test/{id_}/{i}.jpg" for i in range(args.images)]
+            # The title is the stored id, which SynthPusher reads back
+            content = Struct.template1(
+                payload, int(time.time()), title=f"{self.class_name}_{id_}",
+                url=f"https://bench.invalid/{id_}", username="bench", images=images,
+            )  # fmt: skip
+            return GetResult(self.id, int(time.time()), content)
+
+    class SynthPusher(Pusher):
+        async def push(self, content: Struct, to: str = None) -> None:
+            nonlocal failed_pushes
+            sources = [e.source for e in content.content if isinstance(e, StructImage)]
+            if len(await image.download_list(sources)) != len(sources):
+                raise Exception("Failed to download images")
+            await asyncio.sleep(args.pusher_latency)
+            with rng_lock:
+                fail = rng.random() < args.failure_rate
+            if fail:
+                failed_pushes += 1
+                raise Exception("Synthetic failure")
+            article_id = str(content).split("\n", 1)[0]
+            latencies.append(time.perf_counter() - listed_at[article_id])
+
+    core.imported_adapter_classes.update({SynthGetter, SynthPusher})
+    bench_config = config.MainConfig()
+    bench_config.pair = [
+        f"SynthGetter.{i} SynthPusher.{i % args.destinations}."
+        for i in range(args.getters)
+    ]
+    bench_config.policy.refresh_when_start = False
+    bench_config.policy.skip_first = False
+    bench_config.policy.delivery_backoff_base = args.retry_backoff
+    bench_config.policy.delivery_backoff_max = args.retry_backoff * 8
+    core.init(get_config_function=lambda: bench_config)
+
+    expected = args.getters * args.ids * args.rounds
+
+    async def run() -> dict:
+        lag_monitor = LoopLagMonitor()
+        lag_task = asyncio.create_task(lag_monitor.run())
+        core.start_delivery_worker()
+        core.update_getters()
+        assert len(core.registered_getters) == args.getters
+
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            await asyncio.gather(*[core.refresh(g) for g in core.registered_getters])
+        refreshed = time.perf_counter()
+
+        dead = 0
+        while time.perf_counter() - start < args.timeout:
+            dead = await asyncio.to_thread(
+                store.Outbox.select()
+                .where(store.Outbox.state == store.Outbox.DEAD)
+                .count
+            )
+            if len(latencies) + dead >= expected:
+                break
+            await asyncio.sleep(0.05)
+        delivered = time.perf_counter()
+
+        lag_task.cancel()
+        await core.shutdown()
+
+        db_bytes = sum(
+            path.stat().st_size
+            for path in (workdir / "data" / "database").glob("main.db*")
+        )
+        image_bytes = sum(
+            path.stat().st_size for path in image.path.rglob("*") if path.is_file()
+        )
+        sorted_latencies = sorted(latencies)
+        lags = sorted(lag_monitor.lags)
+        return {
+            "getters": args.getters,
+            "articles": store.Article.select().count(),
+            "expected_articles": expected,
+            "delivered": len(latencies),
+            "dead": dead,
+            "failed_pushes": failed_pushes,
+            "refresh_seconds": refreshed - start,
+            "total_seconds": delivered - start,
+            "articles_per_second": expected / (refreshed - start),
+            "delivered_per_second": len(latencies) / (delivered - start),
+            "latency_p50_ms": percentile(sorted_latencies, 0.5) * 1000,
+            "latency_p99_ms": percentile(sorted_latencies, 0.99) * 1000,
+            "latency_max_ms": (sorted_latencies or [0])[-1] * 1000,
+            "image_requests": image_requests,
+            "db_bytes": db_bytes,
+            "image_bytes": image_bytes,
+            "rss_bytes": rss_bytes(),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "loop_lag_mean_ms": statistics.fmean(lags or [0]) * 1000,
+            "loop_lag_p99_ms": percentile(lags, 0.99) * 1000,
+            "loop_lag_max_ms": (lags or [0])[-1] * 1000,
+        }
+
+    report(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Compare refresh throughput and memory of the worker loop pool with the previous
+design, which created a thread and an event loop for every refresh.
+
+Usage: python tool/bench/refresh_engine.py [--getters N] [--rounds N] [--ids N]
+"""
+
+import asyncio
+import concurrent.futures
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from common import peak_rss_bytes, quiet_logging, report, rss_bytes, setup_workdir
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--getters", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--ids", type=int, default=20)
+    parser.add_argument("--design", choices=["legacy", "pool"])
+    return parser.parse_args()
+
+
+def run_design(args):
+    setup_workdir()
+    quiet_logging()
+
+    import config
+    import core
+    import network
+    from model import GetResult, Getter, Struct
+
+    class BenchGetter(Getter):
+        async def list(self) -> list[str]:
+            return [f"{self.id}-{i}" for i in range(args.ids)]
+
+        async def detail(self, id_: str) -> GetResult:
+            return GetResult("bench", int(time.time()), Struct().text(id_))
+
+    test_config = config.MainConfig()
+    test_config.policy.skip_first = True
+    core.init(get_config_function=lambda: test_config)
+
+    async def legacy_refresh(getter):
+        async def thread_worker():
+            with network.force_proxies_patch():
+                return await core.refresh_worker(getter)
+
+        loop = asyncio.get_event_loop()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            return await loop.run_in_executor(
+                executor, lambda: asyncio.run(thread_worker())
+            )
+
+    refresh = legacy_refresh if args.design == "legacy" else core.refresh
+
+    async def main():
+        getters = [BenchGetter(str(i)) for i in range(args.getters)]
+        # Warm up: the first refresh of each getter stores its articles.
+        await asyncio.gather(*[refresh(getter) for getter in getters])
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            await asyncio.gather(*[refresh(getter) for getter in getters])
+        elapsed = time.perf_counter() - start
+        return {
+            "design": args.design,
+            "refreshes": args.getters * args.rounds,
+            "seconds": elapsed,
+            "refresh_per_second": args.getters * args.rounds / elapsed,
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_bytes(),
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+    report(asyncio.run(main()))
+
+
+def main():
+    args = parse_args()
+    if args.design:
+        run_design(args)
+        return
+
+    # Each design runs in a fresh interpreter, so peak RSS is not shared.
+    for design in ["legacy", "pool"]:
+        subprocess.run(
+            [sys.executable, __file__, *sys.argv[1:], "--design", design], check=True
+        )
+
+
+if __name__ == "__main__":
+    main()
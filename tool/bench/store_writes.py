@@ -0,0 +1,132 @@
+"""Measure article inserts/s and /api/articles/ latency under concurrent refresh load,
+with the store writer thread on a WAL database and with the previous setup, where
+every refresh thread wrote directly to a rollback-journal database and API handlers
+read on the event loop.
+
+Both write the articles as refreshes did before the outbox, a lookup and an insert
+in autocommit, so only where and how they're written differs.
+
+Usage: python tool/bench/store_writes.py [--threads N] [--articles N] [--requests N]
+"""
+
+import asyncio
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+from common import quiet_logging, report, setup_workdir
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--articles", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--design", choices=["legacy", "writer"])
+    return parser.parse_args()
+
+
+def run_design(args):
+    workdir = setup_workdir()
+    quiet_logging()
+
+    import httpx
+
+    import api
+    import store
+    from model import GetResult, Struct
+
+    def insert(id_: str, result: GetResult):
+        # What refreshes wrote before the outbox: one autocommit statement each
+        if not store.Article.get_or_none(store.Article.id == id_):
+            store.Article.from_getresult(id_, result).save(force_insert=True)
+
+    if args.design == "legacy":
+        # The previous database settings: rollback journal, sqlite3's 5s busy timeout
+        store.main_db.close()
+        store.main_db.init(
+            str(workdir / "legacy.db"),
+            timeout=5,
+            pragmas={"journal_mode": "delete", "synchronous": "full", "mmap_size": 0},
+        )
+        store.main_db.create_tables([store.Article, store.Outbox])
+
+        async def to_thread(function, *a, **kw):
+            return function(*a, **kw)
+
+        api.asyncio.to_thread = to_thread
+        save = insert
+    else:
+
+        def save(*a):
+            return store.write(insert, *a)
+
+    api.app.dependency_overrides[api.authenticate] = lambda: True
+    errors = []
+
+    def refresh_load(thread: int):
+        try:
+            for i in range(args.articles):
+                result = GetResult(f"bench{thread}", i, Struct().text(f"{thread}-{i}"))
+                save(f"bench{thread}-{i}", result)
+        except Exception as e:
+            errors.append(e)
+
+    async def api_load() -> list[float]:
+        latencies = []
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://b") as c:
+            for i in range(args.requests):
+                start = time.perf_counter()
+                response = await c.get(
+                    "/api/articles/", params={"userId": f"bench{i % args.threads}"}
+                )
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.005)
+        return latencies
+
+    threads = [
+        threading.Thread(target=refresh_load, args=(i,)) for i in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    latencies = asyncio.run(api_load())
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    inserted = store.Article.select().count()
+
+    latencies.sort()
+    report(
+        {
+            "design": args.design,
+            "inserts": inserted,
+            "failed_writers": len(errors),
+            "seconds": elapsed,
+            "inserts_per_second": inserted / elapsed,
+            "api_latency_p50_ms": statistics.median(latencies) * 1000,
+            "api_latency_p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            "api_latency_max_ms": latencies[-1] * 1000,
+        }
+    )
+
+
+def main():
+    args = parse_args()
+    if args.design:
+        run_design(args)
+        return
+
+    for design in ["legacy", "writer"]:
+        subprocess.run(
+            [sys.executable, __file__, *sys.argv[1:], "--design", design], check=True
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compare the compact Struct encoding with the JSON one it replaces: database size,
+encode/decode time, and the time to list article ids, which no longer decodes content.
+
+Usage: python tool/bench/struct_codec.py [--articles N] [--paragraphs N]
+"""
+
+import json
+import random
+import sqlite3
+import string
+import time
+from argparse import ArgumentParser
+
+from common import quiet_logging, report, setup_workdir
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--articles", type=int, default=20000)
+    parser.add_argument("--paragraphs", type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = setup_workdir()
+    quiet_logging()
+
+    import codec
+    import store
+    from model import Struct
+
+    rng = random.Random(0)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=6)) for _ in range(2000)]
+
+    def article(i: int) -> Struct:
+        text = "\n\n".join(
+            " ".join(rng.choices(words, k=rng.randint(10, 120)))
+            for _ in range(args.paragraphs)
+        )
+        images = [f"https://img.example.com/{i}/{n}.jpg" for n in range(i % 4)]
+        return Struct.template1(
+            text, 1700000000 + i, title=f"Title {i}", url=f"https://example.com/{i}",
+            username="bench", images=images,
+        )  # fmt: skip
+
+    structs = [article(i) for i in range(args.articles)]
+
+    def timed(function):
+        start = time.perf_counter()
+        result = function()
+        return result, time.perf_counter() - start
+
+    json_values, json_encode = timed(
+        lambda: [json.dumps(s.asdict(), ensure_ascii=False) for s in structs]
+    )
+    compact_values, compact_encode = timed(lambda: [codec.encode(s) for s in structs])
+    _, json_decode = timed(
+        lambda: [Struct(dict_=json.loads(v)).content for v in json_values]
+    )
+    _, compact_decode = timed(lambda: [codec.decode(v) for v in compact_values])
+
+    sizes = {}
+    list_ids = {}
+    for name, values in [("json", json_values), ("compact", compact_values)]:
+        db_path = workdir / f"{name}.db"
+        db = sqlite3.connect(db_path)
+        db.execute(
+            'CREATE TABLE article (id TEXT PRIMARY KEY, "userId" TEXT, ts INT, content TEXT)'
+        )
+        db.executemany(
+            "INSERT INTO article VALUES (?, 'bench', ?, ?)",
+            [(f"bench-{i}", i, v) for i, v in enumerate(values)],
+        )
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+        sizes[name] = db_path.stat().st_size
+
+        store.main_db.close()
+        store.main_db.init(str(db_path))
+        if name == "json":
+            # Before: every row was decoded as soon as it was read
+            _, list_ids[name] = timed(
+                lambda: [
+                    (a.id, a.content.content) for a in store.Article.select()
+                ]
+            )  # fmt: skip
+        else:
+            _, list_ids[name] = timed(lambda: [a.id for a in store.Article.select()])
+
+    n = args.articles
+    report(
+        {
+            "articles": n,
+            "db_bytes_json": sizes["json"],
+            "db_bytes_compact": sizes["compact"],
+            "db_size_saved": 1 - sizes["compact"] / sizes["json"],
+            "content_bytes_json": sum(len(v.encode()) for v in json_values),
+            "content_bytes_compact": sum(len(v) for v in compact_values),
+            "encode_us_json": json_encode / n * 1e6,
+            "encode_us_compact": compact_encode / n * 1e6,
+            "decode_us_json": json_decode / n * 1e6,
+            "decode_us_compact": compact_decode / n * 1e6,
+            "list_ids_seconds_json": list_ids["json"],
+            "list_ids_seconds_compact": list_ids["compact"],
+            "zstandard": codec.zstandard is not None,
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
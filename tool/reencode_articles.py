@@ -0,0 +1,36 @@
+"""Convert articles stored as JSON by older versions to the compact encoding.
+
+Older articles are readable without it; converting them saves space and makes
+reading them faster. Run it in the directory of the MessageSyncer instance, the
+one containing data/. It can run while MessageSyncer is running, and be
+interrupted and run again.
+
+Usage: python path/to/tool/reencode_articles.py [--batch-size N]
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if not (Path("data") / "database" / "main.db").exists():
+        parser.error("data/database/main.db not found in the current directory")
+
+    import store
+
+    done = store.reencode_articles(
+        args.batch_size, progress=lambda done: print(f"\r{done} articles", end="")
+    )
+    store.writer.stop()
+    print(f"\r{done} articles converted")
+
+
+if __name__ == "__main__":
+    main()